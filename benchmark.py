@@ -0,0 +1,387 @@
+import contextlib
+import io
+import json
+import math
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+
+import reinforcement
+import state_tables
+
+
+class DictQAfterStateAgent(reinforcement.QAfterStateAgent):
+    # 高速化前の行動選択と更新(比較用)
+    # 毎回q_sでdictを作ってからmaxを取る
+    def select_action(self, state, valid_actions):
+        if self.explore and random.random() < self.epsilon:
+            return random.choice(valid_actions)
+        else:
+            q_s = self.q_s(state)
+            valid_q = {action: q_s[action] for action in valid_actions}
+            return max(valid_q, key=valid_q.get)
+
+    def update(self, *data):
+        state, action, reward, next_state, valid_next_actions = data
+
+        afterstate = self.afterstates[state][action]
+        q = self.q_afterstates[afterstate]
+
+        valid_next_q = [self.q_s(next_state)[next_action] for next_action in valid_next_actions]
+        max_q = max(valid_next_q) if valid_next_q else 0
+
+        self.q_afterstates[afterstate] += self.alpha * (reward + self.gamma*max_q - q)
+
+
+def selfplay_speed(agent, selfplay_cls, n_game, seed=0):
+    # 自己対戦の速度を測る
+    # 戻り値: (games/sec, moves/sec)
+    moves = [0]
+    select_action = agent.select_action
+
+    def counting_select_action(state, valid_actions):
+        moves[0] += 1
+        return select_action(state, valid_actions)
+
+    agent.select_action = counting_select_action
+
+    random.seed(seed)
+    selfplay = selfplay_cls(agent, None)
+
+    start = time.perf_counter()
+    for _ in range(n_game):
+        selfplay()
+    elapsed = time.perf_counter() - start
+
+    del agent.select_action
+    return n_game / elapsed, moves[0] / elapsed
+
+
+def compare_select_action(n_game):
+    # 行動選択の高速化前後で自己対戦の速度を比べる
+    from tic_tac_toe import TicTacToeSelfPlay, TicTacToeState
+    from tic_tac_toe_reverse import TicTacToeReverseSelfPlay, TicTacToeReverseState
+
+    for state_cls, selfplay_cls in ((TicTacToeState, TicTacToeSelfPlay),
+                                    (TicTacToeReverseState, TicTacToeReverseSelfPlay)):
+        afterstates = state_cls.afterstates()
+        q_tables = []
+        for agent_cls in (DictQAfterStateAgent, reinforcement.QAfterStateAgent, reinforcement.ArrayQAfterStateAgent):
+            agent = agent_cls(afterstates, epsilon=0.5, explore=True)
+            games, moves = selfplay_speed(agent, selfplay_cls, n_game)
+            q_tables.append(list(agent.q_afterstates))
+            print('{} {}: {:.0f} games/sec, {:.0f} moves/sec'.format(
+                selfplay_cls.__name__, agent_cls.__name__, games, moves))
+
+        # 同じシードなら学習結果は変わらない
+        print('same Q table: {}'.format(all(q == q_tables[0] for q in q_tables)))
+
+
+def line_judge(cells, both_won):
+    # ビット化前の判定(比較用)
+    # 8列を1つずつ比べ、空白のリストで引き分けを判定する
+    result = [0, 0]
+    for pos1, pos2, pos3 in ((0, 1, 2), (3, 4, 5), (6, 7, 8), (0, 3, 6), (1, 4, 7), (2, 5, 8), (0, 4, 8), (2, 4, 6)):
+        if cells[pos1] != 0 and cells[pos1] == cells[pos2] == cells[pos3]:
+            result[cells[pos1] - 1] += 1
+
+    if result[0] != 0 and result[1] != 0:
+        return both_won
+    elif result[0] != 0:
+        return 1
+    elif result[1] != 0:
+        return 2
+    elif [key for key, value in enumerate(cells) if value == 0]:
+        return 0
+    else:
+        return 3
+
+
+def compare_judge(repeat):
+    # 全ての状態についてjudgeを繰り返し、1秒あたりの判定数を比べる
+    from tic_tac_toe import TicTacToeState
+    from tic_tac_toe_reverse import TicTacToeReverseState
+
+    for state_cls, both_won in ((TicTacToeState, -1), (TicTacToeReverseState, 3)):
+        states = [state_cls(code) for code in range(state_cls.N_CODES)]
+        cells = [list(s.cells()) for s in states]
+
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for c in cells:
+                line_judge(c, both_won)
+        line_speed = repeat * len(states) / (time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for s in states:
+                s._judge = None  # キャッシュを使わない
+                s.judge()
+        bit_speed = repeat * len(states) / (time.perf_counter() - start)
+
+        same = all(line_judge(c, both_won) == s.judge() for c, s in zip(cells, states))
+        print('{}.judge: {:.0f} -> {:.0f} judges/sec (same result: {})'.format(
+            state_cls.__name__, line_speed, bit_speed, same))
+
+
+# ベンチマーク集
+# 各ベンチマークはシードを固定して準備し、ウォームアップの後にrepeat回測る
+# 1回の計測はmin_time秒以上になるように、1回分の処理を何度か繰り返す
+# 結果(1秒あたりの処理数)はJSONで保存し、別のコミットの結果と比べて
+# threshold以上遅くなったものを報告する
+
+SUITE_VERSION = 1  # ベンチマークの内容を変えたら上げる(違うバージョンの結果とは比べない)
+
+SEED = 0
+
+_benchmarks = []  # (名前, 準備する関数)
+
+
+def benchmark(name):
+    # ベンチマークを登録するデコレーター
+    # 準備する関数は、1回分の処理をして処理数を返す関数を返す
+    def register(setup):
+        _benchmarks.append((name, setup))
+        return setup
+    return register
+
+
+def _sample_states(state_cls, initial_code, n):
+    # 初期状態から到達できる、可能な行動のある状態をn個選ぶ
+    tables = state_tables.get_tables(state_cls)
+    states, _ = tables.reachable(initial_code)
+    states = [s for s in states if tables.valid_mask[s]]
+    rng = random.Random(SEED)
+    return [state_cls(rng.choice(states)) for _ in range(n)]
+
+
+def _state_benchmarks(state_cls, initial_code, prefix):
+    # 状態クラスのchange, reverse, code, judge
+    @benchmark(prefix + '.change')
+    def setup_change():
+        rng = random.Random(SEED)
+        moves = [(s, rng.choice(s.valid_actions())) for s in _sample_states(state_cls, initial_code, 10000)]
+
+        def run():
+            for s, a in moves:
+                s.change(a, 1)
+            return len(moves)
+        return run
+
+    @benchmark(prefix + '.reverse')
+    def setup_reverse():
+        states = _sample_states(state_cls, initial_code, 10000)
+
+        def run():
+            for s in states:
+                s.reverse()
+            return len(states)
+        return run
+
+    @benchmark(prefix + '.code')
+    def setup_code():
+        # 盤面から作った状態のコード
+        states = [s.clone() for s in _sample_states(state_cls, initial_code, 10000)]
+
+        def run():
+            for s in states:
+                s.code()
+            return len(states)
+        return run
+
+    @benchmark(prefix + '.judge')
+    def setup_judge():
+        states = [state_cls(code) for code in range(state_cls.N_CODES)]
+
+        def run():
+            for s in states:
+                s._judge = None  # キャッシュを使わない
+                s.judge()
+            return len(states)
+        return run
+
+    @benchmark(prefix + '.build_afterstates')
+    def setup_build_afterstates():
+        def run():
+            state_cls.build_afterstates()
+            return 1
+        return run
+
+    @benchmark(prefix + '.afterstates')
+    def setup_afterstates():
+        # キャッシュのファイルからテーブルを読み込んでafterstates()を作る
+        state_tables.get_tables(state_cls)
+
+        def run():
+            state_tables._loaded.clear()
+            state_cls.afterstates()
+            return 1
+        return run
+
+
+def _agent_benchmarks(state_cls, initial_code, prefix):
+    # QAfterStateAgentのselect_action, update
+    def make_agent():
+        agent = reinforcement.QAfterStateAgent(state_cls.afterstates(), epsilon=0.1, explore=True)
+        rng = random.Random(SEED)
+        agent.q_afterstates = [rng.uniform(-1, 1) for _ in agent.q_afterstates]
+        return agent
+
+    @benchmark(prefix + '.select_action')
+    def setup_select_action():
+        agent = make_agent()
+        states = [(s.code(), s.valid_actions()) for s in _sample_states(state_cls, initial_code, 10000)]
+
+        def run():
+            random.seed(SEED)
+            for state, valid_actions in states:
+                agent.select_action(state, valid_actions)
+            return len(states)
+        return run
+
+    @benchmark(prefix + '.update')
+    def setup_update():
+        agent = make_agent()
+        tables = state_tables.get_tables(state_cls)
+        rng = random.Random(SEED)
+        data = []
+        for s in _sample_states(state_cls, initial_code, 10000):
+            state = s.code()
+            action = rng.choice(s.valid_actions())
+            afterstate = tables.afterstates[state][action]
+            judge = tables.judge[afterstate]
+            reward = 1 if judge == 1 else -1 if judge == 2 else 0
+            next_state = tables.reversed[afterstate] if judge == 0 else afterstate
+            data.append((state, action, reward, next_state, tables.valid_actions(afterstate)))
+
+        def run():
+            for d in data:
+                agent.update(*d)
+            return len(data)
+        return run
+
+
+def _selfplay_benchmarks(selfplay_cls, state_cls, name, n_game, array_agent=False):
+    # 自己対戦のゲームループ
+    # 毎回新しいエージェントで同じシードから始めるので、毎回同じゲームになる
+    @benchmark(name)
+    def setup_selfplay():
+        agent_cls = reinforcement.ArrayQAfterStateAgent if array_agent else reinforcement.QAfterStateAgent
+        afterstates = state_cls.afterstates()
+
+        def run():
+            random.seed(SEED)
+            selfplay = selfplay_cls(agent_cls(afterstates, epsilon=0.5, explore=True), None)
+            with contextlib.redirect_stdout(io.StringIO()):  # 途中経過の表示は捨てる
+                for _ in range(n_game):
+                    selfplay()
+            return n_game
+        return run
+
+
+def _register_benchmarks():
+    from tic_tac_toe import TicTacToeCodeSelfPlay, TicTacToeSelfPlay, TicTacToeState
+    from tic_tac_toe_reverse import TicTacToeReverseCodeSelfPlay, TicTacToeReverseSelfPlay, TicTacToeReverseState
+
+    _benchmarks.clear()
+    _state_benchmarks(TicTacToeState, 0, 'state')
+    _state_benchmarks(TicTacToeReverseState, 3 ** 9, 'reverse_state')
+    _agent_benchmarks(TicTacToeState, 0, 'agent')
+    _agent_benchmarks(TicTacToeReverseState, 3 ** 9, 'reverse_agent')
+    _selfplay_benchmarks(TicTacToeSelfPlay, TicTacToeState, 'selfplay', 2000)
+    _selfplay_benchmarks(TicTacToeReverseSelfPlay, TicTacToeReverseState, 'reverse_selfplay', 2000)
+    _selfplay_benchmarks(TicTacToeCodeSelfPlay, TicTacToeState, 'code_selfplay', 5000)
+    _selfplay_benchmarks(TicTacToeReverseCodeSelfPlay, TicTacToeReverseState, 'reverse_code_selfplay', 5000)
+
+
+def run_suite(names=None, repeat=5, warmup=1, min_time=0.2):
+    # ベンチマークを実行して結果のdictを返す
+    # names: 実行するベンチマークの名前の前方一致(Noneなら全て)
+    _register_benchmarks()
+
+    results = {}
+    for name, setup in _benchmarks:
+        if names is not None and not any(name.startswith(n) for n in names):
+            continue
+
+        random.seed(SEED)
+        run = setup()
+        start = time.perf_counter()
+        for _ in range(warmup):
+            run()
+        number = max(1, math.ceil(min_time * warmup / (time.perf_counter() - start)))
+
+        rates = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            n = sum(run() for _ in range(number))
+            rates.append(n / (time.perf_counter() - start))
+
+        results[name] = {
+            'ops_per_sec': max(rates),  # 最良の値(他の処理に邪魔されにくい)
+            'median_ops_per_sec': statistics.median(rates),
+            'repeat': repeat,
+            'number': number,
+        }
+        print('{:<40} {:>14.0f} /sec (median {:.0f})'.format(name, max(rates), statistics.median(rates)))
+
+    return {
+        'suite': SUITE_VERSION,
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+
+
+def compare_results(baseline, current, threshold=0.1):
+    # currentがbaselineよりthreshold(割合)以上遅くなったベンチマークの(名前, 比率)のリスト
+    if baseline.get('suite') != current.get('suite'):
+        raise ValueError('cannot compare suite {} with suite {}'.format(baseline.get('suite'), current.get('suite')))
+
+    regressions = []
+    for name, result in current['results'].items():
+        if name in baseline['results']:
+            ratio = result['ops_per_sec'] / baseline['results'][name]['ops_per_sec']
+            print('{:<40} {:>8.2f}x'.format(name, ratio))
+            if ratio < 1 - threshold:
+                regressions.append((name, ratio))
+    return regressions
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=sys.path[0] or None).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    # python benchmark.py suite [結果のJSON] [比べる結果のJSON] [threshold]
+    #   ベンチマーク集を実行して保存し、比べる結果よりthreshold以上遅いものがあれば終了コード1
+    # python benchmark.py [n_game]
+    #   高速化前後の比較
+    if len(sys.argv) > 1 and sys.argv[1] == 'suite':
+        result = run_suite()
+        if len(sys.argv) > 2:
+            with open(sys.argv[2], 'w') as f:
+                json.dump(result, f, indent=2, sort_keys=True)
+
+        if len(sys.argv) > 3:
+            with open(sys.argv[3]) as f:
+                baseline = json.load(f)
+            threshold = float(sys.argv[4]) if len(sys.argv) > 4 else 0.1
+            regressions = compare_results(baseline, result, threshold)
+            for name, ratio in regressions:
+                print('regression: {} is {:.0%} slower'.format(name, 1 - ratio))
+            sys.exit(1 if regressions else 0)
+        sys.exit()
+
+    n_game = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000  # 自己対戦のゲーム数
+
+    compare_judge(10)
+    compare_select_action(n_game)
@@ -0,0 +1,81 @@
+# 盤面のビット表現
+# マスpos(= 3*y + x)をビット1 << posで表し、xとoの盤面をそれぞれ9ビットの整数で持つ
+
+FULL = (1 << 9) - 1  # 全てのマス
+
+POW3 = tuple(3 ** pos for pos in range(9))
+
+# 各ビットを3進数の桁に置き換えた値
+# 状態コードはBASE3[x] + 2 * BASE3[o]
+BASE3 = tuple(sum(POW3[pos] for pos in range(9) if mask >> pos & 1) for mask in range(1 << 9))
+
+# 立っているビットの数
+POPCOUNT = tuple(bin(mask).count('1') for mask in range(1 << 9))
+
+# 立っているビットの位置
+POSITIONS = tuple(tuple(pos for pos in range(9) if mask >> pos & 1) for mask in range(1 << 9))
+
+# 周囲8マス
+NEIGHBOURS = tuple(
+    sum(1 << (3*y + x)
+        for y in range(max(pos // 3 - 1, 0), min(pos // 3 + 2, 3))
+        for x in range(max(pos % 3 - 1, 0), min(pos % 3 + 2, 3))
+        if 3*y + x != pos)
+    for pos in range(9)
+)
+
+
+def decode(code):
+    # 状態コード(の下9桁)からxとoの盤面を復元する
+    x = 0
+    o = 0
+    for pos in range(9):
+        a = code % 3
+        if a == 1:
+            x |= 1 << pos
+        elif a == 2:
+            o |= 1 << pos
+        code //= 3
+    return x, o
+
+
+def encode(x, o):
+    # xとoの盤面から状態コードを求める
+    return BASE3[x] + 2 * BASE3[o]
+
+
+def cells(x, o):
+    # 各マスの状態(0: blank, 1: x, 2: o)を返す
+    return tuple(1 if x >> pos & 1 else 2 if o >> pos & 1 else 0 for pos in range(9))
+
+# 揃うと勝ちになる8列
+LINES = (
+    0b000000111, 0b000111000, 0b111000000,  # 横
+    0b001001001, 0b010010010, 0b100100100,  # 縦
+    0b100010001, 0b001010100,  # 斜め
+)
+
+# 列が1つでも揃っているか
+WINS = tuple(any(mask & line == line for line in LINES) for mask in range(1 << 9))
+
+# 盤面の8通りの対称変換(回転と鏡映)
+# SYMMETRIES[t][pos]は変換tでマスposが移る先
+SYMMETRIES = tuple(
+    tuple(3*y2 + x2 for x2, y2 in (f(pos % 3, pos // 3) for pos in range(9)))
+    for f in (
+        lambda x, y: (x, y),  # 恒等変換
+        lambda x, y: (2 - y, x),  # 90度回転
+        lambda x, y: (2 - x, 2 - y),  # 180度回転
+        lambda x, y: (y, 2 - x),  # 270度回転
+        lambda x, y: (2 - x, y),  # 左右反転
+        lambda x, y: (x, 2 - y),  # 上下反転
+        lambda x, y: (y, x),  # 対角線で反転
+        lambda x, y: (2 - y, 2 - x),  # 逆対角線で反転
+    )
+)
+
+# SYMMETRY_MASKS[t][mask]はmaskを変換tで移したビット
+SYMMETRY_MASKS = tuple(
+    tuple(sum(1 << symmetry[pos] for pos in POSITIONS[mask]) for mask in range(1 << 9))
+    for symmetry in SYMMETRIES
+)
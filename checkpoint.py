@@ -0,0 +1,403 @@
+import atexit
+import json
+import os
+import pickle
+import queue
+import struct
+import threading
+import time
+
+import numpy as np
+
+
+# Q tableのチェックポイント
+# 先頭にmagicとJSONのヘッダーを置き、その後にQ tableの生の配列を続ける
+#
+#   magic (8 bytes)
+#   ヘッダーの長さ (uint32, little endian)
+#   ヘッダー (JSON, 配列の先頭がALIGNバイト境界になるよう空白で埋める)
+#   Q table (ヘッダーのdtype, shapeの配列)
+#
+# ヘッダーにはformat, shape, dtypeの他、variant(状態クラス名), count(学習ゲーム数),
+# alpha, epsilon, gammaなどを入れる
+
+MAGIC = b'QTTTCKPT'
+FORMAT_VERSION = 1
+ALIGN = 64
+
+_LENGTH = struct.Struct('<I')
+
+
+class CheckpointError(ValueError):
+    pass
+
+
+def save(path, q_afterstates, **info):
+    q_afterstates = np.ascontiguousarray(q_afterstates)
+    _write(path, _array_header(info, q_afterstates), [q_afterstates.tobytes()])
+
+
+def _array_header(info, a):
+    header = dict(info)
+    header['shape'] = list(a.shape)
+    header['dtype'] = a.dtype.str
+    return header
+
+
+def _write(path, header, chunks):
+    # magic, ヘッダー, データ(chunksを続けたもの)を一時ファイルに1回で書き込んでから置き換える
+    header = dict(header)
+    header['format'] = FORMAT_VERSION
+
+    data = json.dumps(header, sort_keys=True).encode('utf-8')
+    size = len(MAGIC) + _LENGTH.size + len(data)
+    data += b' ' * (-size % ALIGN)
+
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(b''.join((MAGIC, _LENGTH.pack(len(data)), data, *chunks)))
+    os.replace(tmp_path, path)
+
+
+def _read_array(path, header, entry, start=0, mmap_mode=None):
+    # ヘッダーのデータの先頭からstartバイトの位置にある、entryのdtype, shapeの配列を読む
+    dtype = np.dtype(entry['dtype'])
+    shape = tuple(entry['shape'])
+    count = int(np.prod(shape))
+    offset = header['offset'] + start
+
+    if os.path.getsize(path) < offset + count * dtype.itemsize:
+        raise CheckpointError('truncated data: {}'.format(path))
+
+    if mmap_mode is not None:
+        return np.memmap(path, dtype=dtype, mode=mmap_mode, offset=offset, shape=shape)
+    return np.fromfile(path, dtype=dtype, count=count, offset=offset).reshape(shape)
+
+
+def read_header(path):
+    # ヘッダーを読む
+    # 配列の位置を'offset'に入れて返す
+    # チェックポイントでなければNone (古いpickle形式など)
+    with open(path, 'rb') as f:
+        head = f.read(len(MAGIC) + _LENGTH.size)
+        if len(head) < len(MAGIC) + _LENGTH.size or head[:len(MAGIC)] != MAGIC:
+            return None
+        length, = _LENGTH.unpack_from(head, len(MAGIC))
+        data = f.read(length)
+
+    if len(data) != length:
+        raise CheckpointError('truncated header: {}'.format(path))
+    try:
+        header = json.loads(data.decode('utf-8'))
+    except ValueError as e:
+        raise CheckpointError('broken header: {}'.format(path)) from e
+    if header.get('format') != FORMAT_VERSION:
+        raise CheckpointError('unsupported format {}: {}'.format(header.get('format'), path))
+
+    header['offset'] = len(head) + length
+    return header
+
+
+def load(path, mmap_mode=None):
+    # Q tableとヘッダーを読み込む
+    # mmap_modeを指定すればnp.memmapで参照する('r', 'r+', 'c')
+    # 古いpickle形式(floatのlist)も読める (ヘッダーは空)
+    # 差分チェックポイントは基準のチェックポイントから復元する(mmapはできない)
+    header = read_header(path)
+    if header is None:
+        with open(path, 'rb') as f:
+            return np.asarray(pickle.load(f), dtype=np.float64), {}
+    if 'arrays' in header:
+        raise CheckpointError('{} has several arrays, use load_arrays'.format(path))
+    if header.get('delta'):
+        return _load_delta(path, header), header
+
+    return _read_array(path, header, header, mmap_mode=mmap_mode), header
+
+
+# 複数の配列をまとめたファイル
+# ヘッダーのarraysに各配列のname, dtype, shape, start(データの先頭からの位置)を入れる
+# 各配列の先頭もALIGNバイト境界に揃える
+
+
+def save_arrays(path, arrays, **info):
+    # arrays: 名前 -> 配列
+    arrays = {name: np.ascontiguousarray(a) for name, a in arrays.items()}
+
+    header = dict(info)
+    header['arrays'] = []
+    chunks = []
+    start = 0
+    for name, a in arrays.items():
+        chunks.append(b'\0' * (-start % ALIGN))
+        start += -start % ALIGN
+        header['arrays'].append({'name': name, 'dtype': a.dtype.str, 'shape': list(a.shape), 'start': start})
+        chunks.append(a.tobytes())
+        start += a.nbytes
+
+    _write(path, header, chunks)
+
+
+def load_arrays(path, mmap_mode=None):
+    # save_arraysで保存した配列(名前 -> 配列のdict)とヘッダーを読み込む
+    header = read_header(path)
+    if header is None or 'arrays' not in header:
+        raise CheckpointError('not an array file: {}'.format(path))
+
+    arrays = {entry['name']: _read_array(path, header, entry, entry['start'], mmap_mode)
+              for entry in header['arrays']}
+    return arrays, header
+
+
+# 差分チェックポイント
+# 前回のチェックポイントから変わった要素の位置(int32)と値だけを保存する
+# ヘッダーにはdelta=True, base(前回のファイル名), n_changedを入れる
+#
+#   ヘッダー (通常のチェックポイントと同じ)
+#   位置 (int32, n_changed個)
+#   値 (dtype, n_changed個)
+
+
+class DeltaWriter:
+    # 差分チェックポイントを書き出す
+    # keyframe_interval回に1回と、差分の方が大きくなる場合は全体を保存する
+    # 差分の基準になるので、書き出すファイルは同じディレクトリに置くこと
+    def __init__(self, keyframe_interval=10):
+        self.keyframe_interval = keyframe_interval
+
+        self.n_saved = 0
+        self._prev = None  # 前回保存したQ table
+        self._prev_path = None
+
+    def save(self, path, q_afterstates, **info):
+        q_afterstates = np.ascontiguousarray(q_afterstates)
+
+        prev = self._prev
+        if (prev is None or prev.shape != q_afterstates.shape or prev.dtype != q_afterstates.dtype
+                or self.n_saved % self.keyframe_interval == 0):
+            changed = None
+        else:
+            changed = np.flatnonzero(q_afterstates != prev).astype(np.int32)
+            if changed.nbytes + changed.size * q_afterstates.itemsize >= q_afterstates.nbytes:
+                changed = None
+
+        if changed is None:
+            save(path, q_afterstates, **info)
+        else:
+            save_delta(path, self._prev_path, q_afterstates, changed, **info)
+
+        self.n_saved += 1
+        self._prev = q_afterstates.copy()
+        self._prev_path = path
+
+
+def save_delta(path, base_path, q_afterstates, changed, **info):
+    # base_pathのQ tableからchangedの位置だけ書き換えた差分を保存する
+    header = _array_header(info, q_afterstates)
+    header['delta'] = True
+    header['base'] = os.path.basename(base_path)
+    header['n_changed'] = len(changed)
+
+    _write(path, header, [changed.astype('<i4').tobytes(), q_afterstates.ravel()[changed].tobytes()])
+
+
+class CheckpointReader:
+    # 差分チェックポイントを含むチェックポイントを読む
+    # 直前に読んだチェックポイントを覚えておき、順番に読む場合は差分を1つ当てるだけにする
+    def __init__(self):
+        self._last_path = None
+        self._last = None
+
+    def load(self, path):
+        header = read_header(path)
+        if header is None or not header.get('delta'):
+            q_afterstates, header = load(path)
+        else:
+            base_path = os.path.join(os.path.dirname(path), header['base'])
+            if self._last is not None and os.path.abspath(base_path) == self._last_path:
+                base = self._last
+            else:
+                base, _ = self.load(base_path)
+            q_afterstates = _apply_delta(path, header, base)
+
+        self._last_path = os.path.abspath(path)
+        self._last = q_afterstates
+        return q_afterstates.copy(), header
+
+
+def _load_delta(path, header):
+    # 差分チェックポイントを基準のチェックポイントから復元する
+    base_path = os.path.join(os.path.dirname(path), header['base'])
+    base, _ = load(base_path)
+    return _apply_delta(path, header, base)
+
+
+def _apply_delta(path, header, base):
+    dtype = np.dtype(header['dtype'])
+    shape = tuple(header['shape'])
+    n = header['n_changed']
+
+    if base.shape != shape or base.dtype != dtype:
+        raise CheckpointError('base of {} has shape {} and dtype {}'.format(path, base.shape, base.dtype.str))
+    if os.path.getsize(path) < header['offset'] + n * (4 + dtype.itemsize):
+        raise CheckpointError('truncated data: {}'.format(path))
+
+    with open(path, 'rb') as f:
+        f.seek(header['offset'])
+        changed = np.fromfile(f, dtype='<i4', count=n)
+        values = np.fromfile(f, dtype=dtype, count=n)
+
+    q_afterstates = np.array(base)
+    q_afterstates.ravel()[changed] = values
+    return q_afterstates
+
+
+class CheckpointWatcher:
+    # pathのファイルを監視し、新しいチェックポイントが置かれたら別スレッドでon_change(path)を呼ぶ
+    # interval秒ごとにファイルの更新時刻, 大きさ, inodeを調べる(作った時点のファイルは読み込み済みとする)
+    # 保存は一時ファイルからos.replaceで置き換えるので、書きかけのファイルを読むことは無い
+    # on_changeが例外を投げたら(壊れたチェックポイントなど)last_errorに入れ、次の変更を待つ
+    def __init__(self, path, on_change, interval=1.0):
+        self.path = path
+        self.on_change = on_change
+        self.interval = interval
+
+        self.n_reloaded = 0
+        self.last_error = None
+
+        self._stamp = self._get_stamp()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='checkpoint-watcher', daemon=True)
+        self._thread.start()
+
+    def check(self):
+        # ファイルが変わっていればon_changeを呼ぶ
+        # 読み込んだらTrueを返す
+        stamp = self._get_stamp()
+        if stamp is None or stamp == self._stamp:
+            return False
+        self._stamp = stamp
+
+        try:
+            self.on_change(self.path)
+        except Exception as e:
+            self.last_error = e
+            return False
+        self.n_reloaded += 1
+        return True
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _get_stamp(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.check()
+
+
+class AsyncWriter:
+    # チェックポイントを別スレッドで書き出す
+    # saveはQ tableを空いているバッファにコピーして書き込みを予約するだけで、すぐに戻る
+    # バッファはmax_pending個で、全て使用中ならsaveは空くまで待つ
+    # 終了時はclose(またはflush)で書き込みの完了を待つ
+    # on_written(seconds)は書き込みが終わるたびに書き込みのスレッドから呼ばれる
+    # (saveが待たされた時間ではなく、実際の書き込みにかかった時間, metrics.TrainingMetrics.checkpoint_written)
+    def __init__(self, writer=None, max_pending=2, on_written=None):
+        self.writer = writer  # Noneなら毎回全体を保存する(DeltaWriterなども使える)
+        self.max_pending = max_pending
+        self.on_written = on_written
+
+        self._free = queue.Queue()  # 空いているバッファ
+        self._pending = queue.Queue()  # 書き込み待ち
+        self._n_buffers = 0
+        self._error = None
+        self._closed = False
+
+        self._thread = threading.Thread(target=self._run, name='checkpoint-writer', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def save(self, path, q_afterstates, **info):
+        self._raise_error()
+        if self._closed:
+            raise CheckpointError('writer is closed')
+
+        buffer = self._get_buffer(q_afterstates)
+        np.copyto(buffer, q_afterstates)
+        self._pending.put((path, buffer, info))
+
+    def flush(self):
+        # 予約した書き込みが全て終わるまで待つ
+        self._pending.join()
+        self._raise_error()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._pending.put(None)
+        self._thread.join()
+        atexit.unregister(self.close)
+        self._raise_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _get_buffer(self, q_afterstates):
+        while True:
+            try:
+                buffer = self._free.get_nowait()
+            except queue.Empty:
+                if self._n_buffers < self.max_pending:
+                    self._n_buffers += 1
+                    return np.empty_like(q_afterstates)
+                buffer = self._free.get()  # 書き込みが終わるまで待つ
+
+            if buffer.shape == q_afterstates.shape and buffer.dtype == q_afterstates.dtype:
+                return buffer
+            # 形の違うバッファは作り直す
+            return np.empty_like(q_afterstates)
+
+    def _run(self):
+        while True:
+            item = self._pending.get()
+            if item is None:
+                self._pending.task_done()
+                return
+
+            path, buffer, info = item
+            try:
+                start = time.perf_counter()
+                if self.writer is None:
+                    save(path, buffer, **info)
+                else:
+                    self.writer.save(path, buffer, **info)
+                if self.on_written is not None:
+                    self.on_written(time.perf_counter() - start)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._free.put(buffer)
+                self._pending.task_done()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error = self._error
+            self._error = None
+            raise CheckpointError('failed to write checkpoint') from error
@@ -0,0 +1,94 @@
+import numpy as np
+
+import metrics
+import solver
+import state_tables
+
+
+# 収束したら学習を打ち切る
+# ConvergenceMonitorはmetrics.TrainingMetricsのhookで、記録のたびに次の値を記録に加え、
+# 指定した条件を全て満たせばconvergedをTrueにする
+#
+#   churn: 前回の記録から貪欲な行動が変わった状態の割合(初期状態から到達できる、可能な行動のある状態のうち)
+#   score: scoreの値 (既定は最善の行動を選ぶ状態の割合, solver.score)
+#
+# 条件 (Noneなら使わない)
+#   max_delta_q: 直近window回の記録のdelta_q_maxが全てこれ以下
+#   mean_delta_q: 直近window回の記録のdelta_q_meanが全てこれ以下
+#   max_churn: 直近window回のchurnが全てこれ以下
+#   min_score: 直近window回のscoreが全てこれ以上
+#
+# Q学習のalphaが一定ならQの変化は0にならず、Qがほぼ同じ行動の間で貪欲な行動も入れ替わり続けるので、
+# delta_qやchurnの閾値は0より大きくすること
+
+
+class ConvergenceMonitor:
+    def __init__(self, agent, state_cls, initial_code, window=3, max_delta_q=None, mean_delta_q=None,
+                 max_churn=None, min_score=None, score=None):
+        self.agent = agent
+        self.window = window
+        self.max_delta_q = max_delta_q
+        self.mean_delta_q = mean_delta_q
+        self.max_churn = max_churn
+        self.min_score = min_score
+
+        # score(agent): 大きいほど良い値 (既定は厳密解との比較, 対戦で推定する関数なども使える)
+        if score is None and min_score is not None:
+            solution = solver.solve(state_cls, initial_code)
+            score = lambda a: solver.score(a, solution)
+        self.score = score
+
+        tables = state_tables.get_tables(state_cls)
+        self.states = [(state, tables.valid_actions(state)) for state in solver.reachable_states(tables, initial_code)]
+
+        self.history = []  # churnとscoreを加えた記録
+        self.converged = False
+        self._prev_actions = None
+
+    def __call__(self, record):
+        actions = self.greedy_actions()
+        record['churn'] = float(np.mean(actions != self._prev_actions)) if self._prev_actions is not None else None
+        self._prev_actions = actions
+        if self.score is not None:
+            record['score'] = self.score(self.agent)
+
+        self.history.append(record)
+        self.converged = self.check()
+        record['converged'] = self.converged
+
+    def greedy_actions(self):
+        argmax_action = self.agent.argmax_action
+        return np.array([argmax_action(state, valid_actions) for state, valid_actions in self.states])
+
+    def check(self):
+        # 直近window回の記録が全ての条件を満たしているか
+        if len(self.history) < self.window:
+            return False
+        recent = self.history[-self.window:]
+
+        for key, limit, sign in (('delta_q_max', self.max_delta_q, 1), ('delta_q_mean', self.mean_delta_q, 1),
+                                 ('churn', self.max_churn, 1), ('score', self.min_score, -1)):
+            if limit is None:
+                continue
+            for record in recent:
+                if record.get(key) is None or sign * record[key] > sign * limit:
+                    return False
+        return True
+
+
+def train(selfplay, monitor, max_games, interval=10000, hooks=()):
+    # 収束するかmax_gamesゲームに達するまで自己対戦する
+    # selfplay.metricsが無ければintervalゲームごとに記録するTrainingMetricsを作る
+    # (hooksは記録を受け取る他のhook, monitorの後に呼ぶのでchurnなども渡される)
+    # 戻り値: 学習したゲーム数
+    if selfplay.metrics is None:
+        selfplay.metrics = metrics.TrainingMetrics(selfplay.agent, interval)
+    selfplay.metrics.hooks[:0] = [monitor, *hooks]
+
+    while selfplay.count < max_games and not monitor.converged:
+        if hasattr(selfplay, 'step'):
+            selfplay.step()  # BatchSelfPlayは1手ずつ進める
+        else:
+            selfplay()
+
+    return selfplay.count
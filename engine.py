@@ -0,0 +1,257 @@
+import time
+
+import numpy as np
+
+import reinforcement
+import state_tables
+
+
+class CodeSelfPlay:
+    # 状態コードとテーブルだけで自己対戦する
+    # 状態オブジェクトを作らないが、エージェントに渡す値と順番は
+    # TicTacToeSelfPlay, TicTacToeReverseSelfPlayと同じなので、乱数のシードが同じなら学習結果も同じ
+    def __init__(self, agent, save_path_format, state_cls, initial_code):
+        self.agent = agent
+        self.save_path_format = save_path_format
+
+        self.state_cls = state_cls
+        self.initial_code = initial_code
+
+        self.tables = state_tables.get_tables(state_cls)
+        self.afterstates = self.tables.afterstates
+        self.count = 0
+
+        self.metrics = None  # metrics.TrainingMetrics (Noneなら計測しない)
+        self.verbose = True  # Falseなら10000ゲームごとの結果を表示しない
+
+        if self.save_path_format is not None:
+            self.save(self.count)
+
+    def __call__(self):
+        stopwatch = self.metrics.stopwatch() if self.metrics is not None else None  # 時間を計るゲームならStopwatch
+        plies = 0
+
+        agent = self.agent
+        afterstates = self.afterstates
+        judge_table = self.tables.judge
+        reversed_table = self.tables.reversed
+        valid_actions = self.tables.valid_actions
+
+        state = self.initial_code
+        valid = valid_actions(state)
+
+        state_o = None  # 1手前の相手の状態と行動
+        action_o = None
+
+        while True:
+            plies += 1
+            if stopwatch is not None:
+                stopwatch.lap('state')
+            action = agent.select_action(state, valid)
+            if stopwatch is not None:
+                stopwatch.lap('select_action')
+            afterstate = afterstates[state][action]  # afterstateはstate_oのnext_state
+
+            judge = judge_table[afterstate]
+            reward = 1 if judge == 1 else -1 if judge == 2 else 0
+
+            valid = valid_actions(afterstate)  # 反転しても可能な行動は同じ
+            if stopwatch is not None:
+                stopwatch.lap('step')
+
+            if state_o is not None:
+                # 1手前の相手の手に対する報酬が得られたので、ここで学習する
+                agent.update(state_o, action_o, -reward, reversed_table[afterstate], valid)
+
+            if judge != 0:
+                # ゲームが終了した場合、最後の状態も評価する
+                agent.update(state, action, reward, afterstate, valid)
+                if stopwatch is not None:
+                    stopwatch.lap('update')
+
+                self.count += 1
+
+                # 10000ゲームに1回結果を表示
+                if self.count % 10000 == 0:
+                    if self.verbose:
+                        print('game {}: {}'.format(self.count, 'win' if judge == 1 else 'lose' if judge == 2 else 'draw'))
+                        print(self.state_cls(afterstate))
+
+                    # # エージェントを保存
+                    if self.save_path_format is not None:
+                        self.save(self.count)
+
+                if self.metrics is not None:
+                    self.metrics.end_games(1, plies)
+
+                return
+
+            if stopwatch is not None:
+                stopwatch.lap('update')
+
+            # 反転して手番を交代する
+            state_o = state
+            action_o = action
+            state = reversed_table[afterstate]
+
+    def save(self, count):
+        # エージェントを保存し、保存で待たされた時間を記録する
+        start = time.perf_counter()
+        self.agent.save(self.save_path_format.format(count), count=count, variant=self.state_cls.__name__)
+        if self.metrics is not None:
+            self.metrics.checkpoint_saved(time.perf_counter() - start)
+
+
+def select_actions(q_afterstates, afterstate_index, state, epsilon, rng):
+    # 状態コードの配列に対してepsilon-greedyで行動を選ぶ
+    # Qが同じ値なら番号の小さい行動(QAfterStateAgent.select_actionと同じ)
+    index = afterstate_index[state]
+    legal = index >= 0
+
+    q = np.where(legal, q_afterstates[index], -np.inf)
+    actions = q.argmax(axis=1)
+
+    if epsilon > 0:
+        explore = rng.random(len(state)) < epsilon
+        if explore.any():
+            # 可能な行動から一様に選ぶ
+            r = np.where(legal[explore], rng.random((explore.sum(), legal.shape[1])), -1)
+            actions[explore] = r.argmax(axis=1)
+
+    return actions
+
+
+class BatchSelfPlay:
+    # n_parallel個のゲームを同時に1手ずつ進める自己対戦
+    # 状態コードをNumPyの配列で持ち、行動選択, 終了判定, Qの更新をまとめて行う
+    # agentはArrayQAfterStateAgent (alpha, gamma, epsilon, exploreをそのまま使う)
+    # agent.afterstate_indexはQ tableの位置として使い、状態の遷移はテーブルから引く
+    # (SymmetricArrayQAfterStateAgentではQ tableの位置とafterstateのコードが異なる)
+    #
+    # 同じ手番で複数のゲームが同じafterstateを更新する場合は、
+    # 更新前のQから計算した更新量の平均を加える
+    def __init__(self, agent, save_path_format, state_cls, initial_code, n_parallel=1024, seed=None):
+        self.agent = agent
+        self.save_path_format = save_path_format
+
+        self.state_cls = state_cls
+        self.initial_code = initial_code
+        self.n_parallel = n_parallel
+        self.rng = np.random.default_rng(seed)
+
+        tables = state_tables.get_tables(state_cls)
+        self.judge = np.frombuffer(tables.judge, dtype=np.int32)
+        self.reversed = np.frombuffer(tables.reversed, dtype=np.int32)
+        self.transitions = reinforcement.dense_afterstates(tables.afterstates)  # [state, action] -> afterstate
+        self.afterstate_index = agent.afterstate_index
+
+        # 進行中のゲーム
+        self.state = np.full(n_parallel, initial_code, dtype=np.int64)
+        self.state_o = np.zeros(n_parallel, dtype=np.int64)  # 1手前の相手の状態
+        self.action_o = np.zeros(n_parallel, dtype=np.int64)  # 1手前の相手の行動
+        self.has_o = np.zeros(n_parallel, dtype=bool)
+
+        self.count = 0
+
+        self.metrics = None  # metrics.TrainingMetrics (Noneなら計測しない)
+        self.verbose = True  # Falseなら10000ゲームごとの結果を表示しない
+
+        if self.save_path_format is not None:
+            self.save(self.count)
+
+    def __call__(self, n_game):
+        # n_gameゲーム終わるまで進める
+        # 途中のゲームは次の呼び出しで続きから進める
+        goal = self.count + n_game
+        while self.count < goal:
+            self.step()
+
+    def select_actions(self, state):
+        # epsilon-greedy
+        epsilon = self.agent.epsilon if self.agent.explore else 0
+        return select_actions(self.agent.q_afterstates, self.afterstate_index, state, epsilon, self.rng)
+
+    def max_q(self, state):
+        # max{Q(after(s, a)); a} (可能な行動が無ければ0)
+        index = self.afterstate_index[state]
+        legal = index >= 0
+        q = np.where(legal, self.agent.q_afterstates[index], -np.inf).max(axis=1)
+        return np.where(legal.any(axis=1), q, 0)
+
+    def step(self):
+        # 全てのゲームを1手進める
+        # 1手ごとの処理はまとめて行うので、計測する場合は毎回時間を計る
+        stopwatch = self.metrics.stopwatch(sample=False) if self.metrics is not None else None
+        agent = self.agent
+        q_afterstates = agent.q_afterstates
+        n = np.arange(self.n_parallel)
+
+        state = self.state
+        action = self.select_actions(state)
+        if stopwatch is not None:
+            stopwatch.lap('select_action')
+        afterstate = self.transitions[state, action]  # afterstateはstate_oのnext_state
+
+        judge = self.judge[afterstate]
+        reward = (judge == 1).astype(np.float64) - (judge == 2)
+        done = judge != 0
+        if stopwatch is not None:
+            stopwatch.lap('step')
+
+        # 1手前の相手の手に対する更新と、終了したゲームの最後の手に対する更新
+        o = n[self.has_o]
+        next_state = self.reversed[afterstate[o]]
+        targets = np.concatenate((
+            -reward[o] + agent.gamma * self.max_q(next_state),
+            reward[done],  # 終了した状態から可能な行動は無い
+        ))
+        updated = np.concatenate((
+            self.afterstate_index[self.state_o[o], self.action_o[o]],
+            self.afterstate_index[state[done], action[done]],
+        ))
+
+        # 同じafterstateへの更新量は平均する
+        delta = agent.alpha * (targets - q_afterstates[updated])
+        total = np.bincount(updated, weights=delta, minlength=len(q_afterstates))
+        counts = np.bincount(updated, minlength=len(q_afterstates))
+        changed = counts > 0
+        q_afterstates[changed] += (total[changed] / counts[changed]).astype(q_afterstates.dtype)
+        if stopwatch is not None:
+            stopwatch.lap('update')
+
+        # 反転して手番を交代する
+        self.state_o = state
+        self.action_o = action
+        self.has_o = ~done
+        self.state = np.where(done, self.initial_code, self.reversed[afterstate])
+        if stopwatch is not None:
+            stopwatch.lap('state')
+
+        if done.any():
+            self.finish(afterstate[done], judge[done])
+
+        if self.metrics is not None:
+            # 終わったゲームの手数の代わりに、進めた手数を数える
+            self.metrics.end_games(int(done.sum()), self.n_parallel)
+
+    def finish(self, afterstates, judges):
+        # 終了したゲームを数え、10000ゲームに1回結果を表示して保存する
+        count = self.count
+        self.count += len(afterstates)
+
+        for i in range(count // 10000 + 1, self.count // 10000 + 1):
+            if self.verbose:
+                judge = judges[-1]
+                print('game {}: {}'.format(i * 10000, 'win' if judge == 1 else 'lose' if judge == 2 else 'draw'))
+                print(self.state_cls(int(afterstates[-1])))
+
+            # # エージェントを保存
+            if self.save_path_format is not None:
+                self.save(i * 10000)
+
+    def save(self, count):
+        # エージェントを保存し、保存で待たされた時間を記録する
+        start = time.perf_counter()
+        self.agent.save(self.save_path_format.format(count), count=count, variant=self.state_cls.__name__)
+        if self.metrics is not None:
+            self.metrics.checkpoint_saved(time.perf_counter() - start)
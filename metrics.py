@@ -0,0 +1,179 @@
+import csv
+import json
+import threading
+import time
+
+import numpy as np
+
+
+# 学習の計測
+# 自己対戦のクラスのmetricsにTrainingMetricsを入れると、interval(ゲーム数)ごとに次の値をまとめて
+# hooksに渡す(hookは記録のdictを受け取る関数, CSVSinkやJSONLSinkなど)
+#
+#   games, plies, time: 通算のゲーム数, 手数, 経過時間(秒)
+#   games_per_sec, plies_per_sec: この区間の学習速度
+#   state, select_action, step, update: 時間を計ったゲームでの各処理の時間の割合
+#       (state: 状態の取得や反転, step: 行動による状態の変化と判定)
+#   checkpoints, checkpoint_ms, checkpoint_max_ms: この区間の保存の回数と、保存で待たされた時間の平均と最大
+#   checkpoint_writes, checkpoint_write_ms, checkpoint_write_max_ms: この区間に書き終わった保存の回数と、
+#       ファイルの書き込みにかかった時間の平均と最大 (checkpoint.AsyncWriterのon_writtenにcheckpoint_writtenを渡した場合)
+#   delta_q_max, delta_q_mean: この区間でのQの変化の絶対値の最大と平均
+#
+# 処理ごとの時間はsample_intervalゲームに1回だけ計るので、計測したままでもほとんど遅くならない
+
+TIME_KEYS = ('state', 'select_action', 'step', 'update')
+
+# churn, score, convergedはconvergence.ConvergenceMonitorが加える
+FIELDS = ('games', 'plies', 'time', 'games_per_sec', 'plies_per_sec') + TIME_KEYS + (
+    'checkpoints', 'checkpoint_ms', 'checkpoint_max_ms', 'checkpoint_writes', 'checkpoint_write_ms',
+    'checkpoint_write_max_ms', 'delta_q_max', 'delta_q_mean', 'churn', 'score', 'converged')
+
+
+class Stopwatch:
+    # 前回のlapからの時間を処理ごとに足していく
+    def __init__(self, times):
+        self.times = times
+        self.last = time.perf_counter()
+
+    def lap(self, name):
+        now = time.perf_counter()
+        self.times[name] += now - self.last
+        self.last = now
+
+
+class TrainingMetrics:
+    def __init__(self, agent, interval=10000, sample_interval=100, hooks=()):
+        self.agent = agent  # Qの変化を計るエージェント
+        self.interval = interval
+        self.sample_interval = sample_interval
+        self.hooks = list(hooks)
+
+        self.games = 0
+        self.plies = 0
+        self.records = []  # これまでの記録
+
+        self._start = time.perf_counter()
+        self._write_lock = threading.Lock()  # checkpoint_writtenは書き込みのスレッドから呼ばれる
+        self._write_times = []  # reportで取り出す
+        self._reset_interval()
+
+    def stopwatch(self, sample=True):
+        # 時間を計るゲーム(sample_intervalゲームに1回)ならStopwatch, それ以外はNone
+        # sample=Falseなら毎回Stopwatchを返す(1回の処理が大きい場合)
+        if sample and self.games % self.sample_interval != 0:
+            return None
+        return Stopwatch(self._times)
+
+    def end_games(self, n_games, n_plies):
+        # ゲームが終わるたびに呼ぶ
+        games = self.games
+        self.games += n_games
+        self.plies += n_plies
+        if games // self.interval != self.games // self.interval:
+            self.report()
+
+    def checkpoint_saved(self, seconds):
+        # 保存で待たされた時間
+        self._checkpoint_times.append(seconds)
+
+    def checkpoint_written(self, seconds):
+        # 保存のファイルの書き込みにかかった時間 (別スレッドで書き込む場合はcheckpoint_savedと異なる)
+        with self._write_lock:
+            self._write_times.append(seconds)
+
+    def report(self):
+        # この区間の記録をまとめてhooksに渡す
+        now = time.perf_counter()
+        elapsed = now - self._interval_start
+
+        record = {
+            'games': self.games,
+            'plies': self.plies,
+            'time': now - self._start,
+            'games_per_sec': (self.games - self._interval_games) / elapsed if elapsed > 0 else None,
+            'plies_per_sec': (self.plies - self._interval_plies) / elapsed if elapsed > 0 else None,
+        }
+
+        total = sum(self._times.values())
+        for key in TIME_KEYS:
+            record[key] = self._times[key] / total if total > 0 else None
+
+        checkpoint_times = self._checkpoint_times
+        record['checkpoints'] = len(checkpoint_times)
+        record['checkpoint_ms'] = 1000 * sum(checkpoint_times) / len(checkpoint_times) if checkpoint_times else None
+        record['checkpoint_max_ms'] = 1000 * max(checkpoint_times) if checkpoint_times else None
+
+        with self._write_lock:
+            write_times = self._write_times
+            self._write_times = []
+        record['checkpoint_writes'] = len(write_times)
+        record['checkpoint_write_ms'] = 1000 * sum(write_times) / len(write_times) if write_times else None
+        record['checkpoint_write_max_ms'] = 1000 * max(write_times) if write_times else None
+
+        q_afterstates = self._q_afterstates()
+        if len(q_afterstates) == len(self._prev_q_afterstates):
+            delta = np.abs(q_afterstates - self._prev_q_afterstates)
+            record['delta_q_max'] = float(delta.max()) if len(delta) else 0.0
+            record['delta_q_mean'] = float(delta.mean()) if len(delta) else 0.0
+        else:
+            record['delta_q_max'] = record['delta_q_mean'] = None
+
+        self.records.append(record)
+        for hook in self.hooks:
+            hook(record)
+
+        self._reset_interval(q_afterstates)
+        return record
+
+    def _q_afterstates(self):
+        return np.array(self.agent.q_afterstates, dtype=np.float64)
+
+    def _reset_interval(self, q_afterstates=None):
+        self._interval_start = time.perf_counter()
+        self._interval_games = self.games
+        self._interval_plies = self.plies
+        self._times = dict.fromkeys(TIME_KEYS, 0.0)
+        self._checkpoint_times = []
+        self._prev_q_afterstates = self._q_afterstates() if q_afterstates is None else q_afterstates
+
+
+class CSVSink:
+    # 記録をCSVファイルに1行ずつ追記する
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'a', newline='')
+        self._writer = csv.DictWriter(self._file, FIELDS, extrasaction='ignore')
+        if self._file.tell() == 0:
+            self._writer.writeheader()
+
+    def __call__(self, record):
+        self._writer.writerow(record)
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class JSONLSink:
+    # 記録をJSON Linesのファイルに1行ずつ追記する
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'a')
+
+    def __call__(self, record):
+        self._file.write(json.dumps(record) + '\n')
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def print_record(record):
+    # 記録を1行で表示するhook
+    s = ('games {games}: {games_per_sec:.0f} games/sec, {plies_per_sec:.0f} plies/sec, '
+         'delta Q max {delta_q_max:.4f} mean {delta_q_mean:.6f}'.format(**record))
+    if record.get('churn') is not None:
+        s += ', churn {:.4f}'.format(record['churn'])
+    if record.get('score') is not None:
+        s += ', score {:.4f}'.format(record['score'])
+    print(s)
@@ -0,0 +1,178 @@
+import multiprocessing
+import queue
+import random
+import time
+
+import engine
+import reinforcement
+import state_tables
+
+
+class ParallelSelfPlay:
+    # 複数のプロセスで自己対戦して1つのQ tableを学習する
+    # Q tableは共有メモリに置き、各ワーカーはBatchSelfPlayでn_parallel個のゲームを同時に進める
+    # (ゲーム数はBatchSelfPlayと同じく、1手で終わった分だけ指定より多くなることがある)
+    #
+    # mode
+    #   'hogwild': 全てのワーカーが共有メモリのQ tableをロックせずに直接更新する
+    #   'merge': 各ワーカーは手元のコピーを更新し、sync_intervalゲームごとに
+    #            前回の同期からの差分を共有メモリのQ tableに足して、最新のQ tableを取り込む
+    def __init__(self, agent, state_cls, initial_code, n_workers=None, sync_interval=1000, mode='hogwild', seeds=None,
+                 n_parallel=1024):
+        if mode not in ('hogwild', 'merge'):
+            raise ValueError('unknown mode: {}'.format(mode))
+
+        self.agent = agent  # ArrayQAfterStateAgent (SymmetricArrayQAfterStateAgentなども使える)
+        self.state_cls = state_cls
+        self.initial_code = initial_code
+
+        self.n_workers = n_workers or multiprocessing.cpu_count()
+        self.sync_interval = sync_interval
+        self.mode = mode
+        self.n_parallel = n_parallel
+
+        if seeds is None:
+            seeds = [random.randrange(2 ** 32) for _ in range(self.n_workers)]
+        if len(seeds) != self.n_workers:
+            raise ValueError('need one seed per worker')
+        self.seeds = list(seeds)
+
+        self.count = 0
+
+    def __call__(self, n_game):
+        # 全ワーカーの合計でn_gameゲーム学習し、結果をagentのQ tableに書き戻す
+        # 戻り値: 学習速度などの統計
+        shm_name = self.agent.create_shared_memory()
+        try:
+            params = {
+                'alpha': self.agent.alpha,
+                'epsilon': self.agent.epsilon,
+                'gamma': self.agent.gamma,
+                'explore': self.agent.explore,
+                'initial_code': self.agent.initial_code,
+            }
+            lock = multiprocessing.Lock()
+            results = multiprocessing.Queue()
+
+            workers = []
+            for i, seed in enumerate(self.seeds):
+                worker_games = n_game // self.n_workers + (1 if i < n_game % self.n_workers else 0)
+                workers.append(multiprocessing.Process(target=_worker, args=(
+                    type(self.agent), shm_name, self.agent.q_afterstates.dtype.str, self.state_cls, self.initial_code,
+                    params, worker_games, self.sync_interval, self.mode, self.n_parallel, seed, lock, results)))
+
+            start = time.perf_counter()
+            for worker in workers:
+                worker.start()
+            stats = _collect(workers, results)
+            for worker in workers:
+                worker.join()
+            elapsed = time.perf_counter() - start
+        finally:
+            # 学習後のQ tableを手元にコピーして共有メモリを削除する
+            self.agent.detach()
+
+        played = sum(s['games'] for s in stats)
+        self.count += played
+
+        return {
+            'n_workers': self.n_workers,
+            'mode': self.mode,
+            'games': played,
+            'time': elapsed,
+            'games_per_sec': played / elapsed,
+            'workers': sorted(stats, key=lambda s: s['seed']),
+        }
+
+
+def _collect(workers, results, poll_interval=1.0):
+    # 全ワーカーの統計を受け取る
+    # 異常終了したワーカーがあれば、残りのワーカーを止めてRuntimeErrorを投げる
+    # (例外のトレースバックはワーカーが標準エラー出力に表示する)
+    stats = []
+    while len(stats) < len(workers):
+        try:
+            stats.append(results.get(timeout=poll_interval))
+            continue
+        except queue.Empty:
+            pass
+
+        failed = [worker for worker in workers if worker.exitcode not in (None, 0)]
+        if not failed and all(worker.exitcode == 0 for worker in workers) and results.empty():
+            failed = workers  # 統計を送らずに終了した
+        if failed:
+            for worker in workers:
+                if worker.is_alive():
+                    worker.terminate()
+                worker.join()
+            raise RuntimeError('worker failed: {}'.format(
+                ', '.join('{} (exit code {})'.format(worker.name, worker.exitcode) for worker in failed)))
+    return stats
+
+
+def _worker(agent_cls, shm_name, dtype, state_cls, initial_code, params, n_game, sync_interval, mode, n_parallel, seed,
+            lock, results):
+    # ワーカープロセス
+    random.seed(seed)
+
+    agent = agent_cls(state_tables.get_tables(state_cls), dtype=dtype, **params)
+    agent.attach_shared_memory(shm_name)
+    shared = agent.q_afterstates
+    if mode == 'merge':
+        with lock:
+            agent.q_afterstates = shared.copy()
+        base = agent.q_afterstates.copy()
+    selfplay = engine.BatchSelfPlay(agent, None, state_cls, initial_code, n_parallel, seed)
+    selfplay.verbose = False  # 各ワーカーが結果を表示すると出力が混ざる
+
+    start = time.perf_counter()
+    while selfplay.count < n_game:
+        selfplay(min(sync_interval, n_game - selfplay.count))
+
+        if mode == 'merge':
+            # 前回の同期からの差分を足して、他のワーカーの学習結果を取り込む
+            with lock:
+                shared += agent.q_afterstates - base
+                agent.q_afterstates[:] = shared
+            base[:] = agent.q_afterstates
+    elapsed = time.perf_counter() - start
+
+    # 共有メモリを閉じる前に参照を外す
+    agent.q_afterstates = shared
+    del shared
+    agent.detach()
+
+    played = selfplay.count
+    results.put({'seed': seed, 'games': played, 'time': elapsed, 'games_per_sec': played / elapsed})
+
+
+def scaling_efficiency(single, parallel):
+    # 1ワーカーでの学習速度に対する並列化の効率(1なら理想的な線形スケール)
+    return parallel['games_per_sec'] / (single['games_per_sec'] * parallel['n_workers'])
+
+
+if __name__ == '__main__':
+    import sys
+
+    from tic_tac_toe import TicTacToeState
+    from tic_tac_toe_reverse import TicTacToeReverseState
+
+    n_game = int(sys.argv[1]) if len(sys.argv) > 1 else 100000  # ワーカー数ごとの学習ゲーム数
+    mode = sys.argv[2] if len(sys.argv) > 2 else 'hogwild'
+
+    worker_counts = [1]
+    while worker_counts[-1] * 2 <= multiprocessing.cpu_count():
+        worker_counts.append(worker_counts[-1] * 2)
+
+    for state_cls, initial_code in ((TicTacToeState, 0), (TicTacToeReverseState, 3 ** 9)):
+        single = None
+        for n_workers in worker_counts:
+            agent = reinforcement.ArrayQAfterStateAgent(state_tables.get_tables(state_cls), epsilon=0.5, explore=True)
+            selfplay = ParallelSelfPlay(agent, state_cls, initial_code, n_workers, mode=mode, seeds=range(n_workers))
+            stats = selfplay(n_game)
+            if single is None:
+                single = stats
+
+            print('{} {} workers: {:.0f} games/sec, speedup {:.2f}, efficiency {:.2f}'.format(
+                state_cls.__name__, n_workers, stats['games_per_sec'],
+                stats['games_per_sec'] / single['games_per_sec'], scaling_efficiency(single, stats)))
@@ -0,0 +1,156 @@
+import os
+
+import numpy as np
+
+import checkpoint
+import reinforcement
+
+
+# 学習済みのQ tableから書き出した貪欲な方策の表(方策表)
+# 学習が終われば各状態の最善の行動は変わらないので、対戦時にQを比べ直さずに済む
+#
+#   action[code]: 最善の行動 (QAfterStateAgent.argmax_actionと同じ, 可能な行動が無ければ-1)
+#   hint_actions[code]: Qの大きい順に並べた可能な行動 (同じ値なら番号の小さい順, 残りは-1)
+#   hint_q[code]: hint_actionsの各行動のQ (残りはnan)
+#
+# checkpoint.save_arraysの形式で保存するので、読み込むのに状態のテーブルもpickleも要らない
+
+POLICY_VERSION = 1  # 方策表の構成を変えたら上げる
+
+
+def compile_policy(agent):
+    # エージェントのQ tableから方策表(名前 -> 配列)を作る
+    if hasattr(agent, 'afterstate_index'):
+        afterstate_index = agent.afterstate_index
+    else:
+        afterstate_index = reinforcement.dense_afterstates(agent.afterstates)
+    legal = afterstate_index >= 0
+
+    q = np.where(legal, np.asarray(agent.q_afterstates, dtype=np.float64)[afterstate_index], -np.inf)
+    order = np.argsort(-q, axis=1, kind='stable')
+    legal = np.take_along_axis(legal, order, axis=1)
+
+    hint_actions = np.where(legal, order, -1).astype(np.int8)
+    return {
+        'action': hint_actions[:, 0].copy(),
+        'hint_actions': hint_actions,
+        'hint_q': np.where(legal, np.take_along_axis(q, order, axis=1), np.nan),
+    }
+
+
+def export(agent, path, **info):
+    # 方策表を書き出す
+    # infoはヘッダーに追加する情報(variant, countなど)
+    checkpoint.save_arrays(path, compile_policy(agent), kind='policy', policy=POLICY_VERSION, **info)
+
+
+def export_checkpoint(state_cls, checkpoint_path, path):
+    # Q tableのチェックポイントから方策表を書き出す
+    q_afterstates, header = checkpoint.load(checkpoint_path)
+    if header.get('variant', state_cls.__name__) != state_cls.__name__:
+        raise checkpoint.CheckpointError('{} is a checkpoint of {}'.format(checkpoint_path, header['variant']))
+
+    agent = reinforcement.QAfterStateAgent(state_cls.afterstates())
+    if len(q_afterstates) != len(agent.q_afterstates):
+        raise checkpoint.CheckpointError('checkpoint {} has {} entries, expected {}'.format(
+            checkpoint_path, len(q_afterstates), len(agent.q_afterstates)))
+    agent.q_afterstates = q_afterstates
+
+    info = {'variant': state_cls.__name__, 'source': os.path.basename(checkpoint_path)}
+    if 'count' in header:
+        info['count'] = header['count']
+    export(agent, path, **info)
+
+
+def load_policy(state_cls, checkpoint_path, path=None):
+    # チェックポイントの方策表を読み込む
+    # 方策表が無いかチェックポイントより古ければ書き出してから読み込む
+    if path is None:
+        path = checkpoint_path + '.policy'
+
+    try:
+        if os.path.getmtime(path) >= os.path.getmtime(checkpoint_path):
+            agent = PolicyAgent(path)
+            if agent.variant == state_cls.__name__:
+                return agent
+    except (OSError, checkpoint.CheckpointError):
+        pass
+
+    export_checkpoint(state_cls, checkpoint_path, path)
+    return PolicyAgent(path)
+
+
+class PolicyAgent(reinforcement.Agent):
+    # 方策表だけで手を選ぶ推論専用のエージェント (学習はしない)
+    # epsilon-greedyの探索はしない
+    def __init__(self, path):
+        arrays, header = checkpoint.load_arrays(path)
+        if header.get('kind') != 'policy' or header.get('policy') != POLICY_VERSION:
+            raise checkpoint.CheckpointError('not a policy table: {}'.format(path))
+
+        self.actions = arrays['action'].tolist()  # 1手ごとにNumPyの値を変換しないようlistで持つ
+        self.hint_actions = arrays['hint_actions']
+        self.hint_q = arrays['hint_q']
+        self.variant = header.get('variant')
+        self.count = header.get('count')
+
+        self.epsilon = 0
+        self.explore = False
+
+    def policy(self, state, action):
+        return 1 if action == self.actions[state] else 0
+
+    def select_action(self, state, valid_actions):
+        return self.actions[state]
+
+    def argmax_action(self, state, valid_actions):
+        return self.actions[state]
+
+    def hints(self, state):
+        # (行動, Q)のリスト (Qの大きい順)
+        n = int((self.hint_actions[state] >= 0).sum())
+        return list(zip(self.hint_actions[state, :n].tolist(), self.hint_q[state, :n].tolist()))
+
+    def q_s(self, state):
+        # Q(s)
+        return dict(self.hints(state))
+
+    def update(self, *data):
+        pass
+
+
+if __name__ == '__main__':
+    import time
+
+    import solver
+    from tic_tac_toe import TicTacToeState
+    from tic_tac_toe_reverse import TicTacToeReverseState
+
+    # 保存してあるQ tableの方策表を書き出し、読み込みと1手あたりの時間を比べる
+    for state_cls, initial_code, checkpoint_path in ((TicTacToeState, 0, 'save/tic_tac_toe_q'),
+                                                     (TicTacToeReverseState, 3 ** 9, 'save/tic_tac_toe_reverse_q')):
+        path = checkpoint_path + '.policy'
+        export_checkpoint(state_cls, checkpoint_path, path)
+        states = solver.solve(state_cls, initial_code).reachable.tolist()
+        valid_actions = {state: state_cls(state).valid_actions() for state in states}
+
+        start = time.perf_counter()
+        agent = PolicyAgent(path)
+        policy_load = time.perf_counter() - start
+
+        start = time.perf_counter()
+        q_agent = reinforcement.QAfterStateAgent(state_cls.afterstates())
+        q_agent.load(checkpoint_path)
+        q_load = time.perf_counter() - start
+
+        for name, a, load in (('QAfterStateAgent', q_agent, q_load), ('PolicyAgent', agent, policy_load)):
+            start = time.perf_counter()
+            for _ in range(10):
+                for state in states:
+                    a.select_action(state, valid_actions[state])
+            per_move = (time.perf_counter() - start) / (10 * len(states))
+            print('{} {}: load {:.1f} ms, {:.2f} us/move'.format(state_cls.__name__, name, load * 1000, per_move * 1e6))
+
+        same = all(agent.select_action(s, valid_actions[s]) == q_agent.select_action(s, valid_actions[s])
+                   for s in states)
+        print('{}: same moves {}'.format(state_cls.__name__, same))
@@ -1,6 +1,11 @@
 from abc import ABCMeta, abstractmethod
 import random
-import pickle
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import checkpoint
+import state_tables
 
 
 class Environment(metaclass=ABCMeta):
@@ -36,14 +41,20 @@ class Agent(metaclass=ABCMeta):
         pass
 
     @staticmethod
-    def _save(path, data):
-        with open(path, 'wb') as f:
-            pickle.dump(data, f)
+    def _save(path, data, writer=None, **info):
+        # 配列とヘッダーをチェックポイント形式で保存する(checkpoint参照)
+        # writerを指定すればwriter.saveで保存する(checkpoint.DeltaWriterなど)
+        if isinstance(data, list):
+            data = np.asarray(data, dtype=np.float64)
+        if writer is None:
+            checkpoint.save(path, data, **info)
+        else:
+            writer.save(path, data, **info)
 
     @staticmethod
     def _load(path):
-        with open(path, 'rb') as f:
-            return pickle.load(f)
+        # 古いpickle形式も読める
+        return checkpoint.load(path)[0]
 
 
 # class QAgent(Agent):
@@ -90,6 +101,8 @@ class QAfterStateAgent(Agent):
 
         self.explore = explore
 
+        self.checkpoint_writer = None  # Noneなら毎回Q table全体を保存する
+
     def q(self, state, action):
         # Q(s, a)
         return self.q_afterstates[self.afterstates[state][action]]
@@ -113,9 +126,30 @@ class QAfterStateAgent(Agent):
         if self.explore and random.random() < self.epsilon:
             return random.choice(valid_actions)
         else:
-            q_s = self.q_s(state)
-            valid_q = {action: q_s[action] for action in valid_actions}
-            return max(valid_q, key=valid_q.get)
+            return self.argmax_action(state, valid_actions)
+
+    def argmax_action(self, state, valid_actions):
+        # 可能な行動のうちQが最大の行動を返す(同じ値なら先の行動)
+        # q_sのようにdictを作らず、afterstateの対応から直接引く
+        sub = self.afterstates[state]
+        q_afterstates = self.q_afterstates
+
+        best_action = valid_actions[0]
+        best_q = q_afterstates[sub[best_action]]
+        for action in valid_actions:
+            q = q_afterstates[sub[action]]
+            if q > best_q:
+                best_action = action
+                best_q = q
+        return best_action
+
+    def max_q(self, state, valid_actions):
+        # max{Q(after(s, a)); a}
+        if not valid_actions:
+            return 0
+        sub = self.afterstates[state]
+        q_afterstates = self.q_afterstates
+        return max([q_afterstates[sub[action]] for action in valid_actions])
 
     def update(self, *data):
         # Q-learning
@@ -125,13 +159,297 @@ class QAfterStateAgent(Agent):
         afterstate = self.afterstates[state][action]
         q = self.q_afterstates[afterstate]
 
-        valid_next_q = [self.q_s(next_state)[next_action] for next_action in valid_next_actions]
-        max_q = max(valid_next_q) if valid_next_q else 0
+        max_q = self.max_q(next_state, valid_next_actions)
 
         self.q_afterstates[afterstate] += self.alpha * (reward + self.gamma*max_q - q)
 
-    def save(self, path):
-        self._save(path, self.q_afterstates)
+    def save(self, path, **info):
+        # infoはヘッダーに追加する情報(count, variantなど)
+        self._save(path, self.q_afterstates, self.checkpoint_writer, **self.hyperparameters(), **info)
 
     def load(self, path):
-        self.q_afterstates = self._load(path)
+        self.q_afterstates = self.convert_q_afterstates(self._load(path))
+
+    def convert_q_afterstates(self, q_afterstates):
+        # 読み込んだQ tableをこのエージェントで使う形にする
+        if len(q_afterstates) != len(self.q_afterstates):
+            raise checkpoint.CheckpointError('Q table has {} entries, expected {}'.format(
+                len(q_afterstates), len(self.q_afterstates)))
+        return np.asarray(q_afterstates).tolist()
+
+    def reload(self, path, variant=None):
+        # チェックポイントを読み込んで検証してから、Q tableを1回の代入で入れ替える
+        # variantを指定すればヘッダーのvariantが違うチェックポイントは読み込まない
+        q_afterstates, header = checkpoint.load(path)
+        if variant is not None and header.get('variant', variant) != variant:
+            raise checkpoint.CheckpointError('{} is a checkpoint of {}'.format(path, header['variant']))
+        self.q_afterstates = self.convert_q_afterstates(q_afterstates)
+
+    def watch(self, path, variant=None, interval=1.0):
+        # pathに新しいチェックポイントが置かれるたびにreloadする(checkpoint.CheckpointWatcher参照)
+        # 読み込みと検証は監視するスレッドで行い、行動選択はQ tableを1回だけ参照するので、
+        # 入れ替えの途中で待たされたり新旧のQ tableが混ざったりすることは無い
+        return checkpoint.CheckpointWatcher(path, lambda p: self.reload(p, variant), interval)
+
+    def hyperparameters(self):
+        return {'alpha': self.alpha, 'epsilon': self.epsilon, 'gamma': self.gamma}
+
+
+class ArrayQAfterStateAgent(QAfterStateAgent):
+    # Q tableをNumPyの配列で持つQAfterStateAgent
+    # afterstate_index[state, action]はafterstateのQ tableでの位置(不可能な行動は-1)
+    #
+    # after_statesはstate_tables.StateTablesか、平坦な配列(offsets, actions, afterstates)でもよい
+    # (状態ごとのdictを作らずに済む, state_tables.AfterstateTable参照)
+    #
+    # initial_codeを指定すると、初期状態から到達できるafterstateだけのQ tableにする
+    # (after_statesはstate_tables.AfterstateTableかStateTables)
+    # その場合、到達できない状態では全ての行動を不可能として扱う
+    def __init__(self, after_states, alpha=0.1, epsilon=0.1, gamma=0.9, explore=False, dtype=np.float64,
+                 initial_code=None):
+        self.alpha = alpha
+        self.epsilon = epsilon
+        self.gamma = gamma
+        self.initial_code = initial_code
+
+        after_states = _afterstate_table(after_states)
+        index = dense_afterstates(after_states)
+        if initial_code is None:
+            afterstates = np.arange(len(after_states), dtype=np.int32)
+        else:
+            states, afterstates = after_states.tables.reachable(initial_code)
+            reachable = np.zeros(len(index), dtype=bool)
+            reachable[np.frombuffer(states, dtype=np.int32)] = True
+            index[~reachable] = -1
+            afterstates = np.frombuffer(afterstates, dtype=np.int32)
+
+        # slot_index[afterstateのコード]: Q tableでの位置 (Q tableに無ければ-1)
+        # afterstate_codes[位置]: その位置のafterstateのコード (複数あれば最小のもの)
+        self.slot_index = self._slot_index(after_states, afterstates)
+        n_slots = int(self.slot_index.max()) + 1
+        self.afterstate_codes = np.full(n_slots, len(after_states), dtype=np.int32)
+        np.minimum.at(self.afterstate_codes, self.slot_index[afterstates], afterstates)
+
+        self.afterstate_index = np.where(index >= 0, self.slot_index[index], -1).astype(np.int32)
+        self.q_afterstates = np.zeros(n_slots, dtype=dtype)  # initial value
+
+        self.explore = explore
+
+        self.checkpoint_writer = None  # Noneなら毎回Q table全体を保存する
+
+        # 共有メモリやファイルのQ tableを参照している場合
+        self._shared_memory = None
+        self._shared_memory_owner = False
+        self._attached = False
+
+    def q(self, state, action):
+        # Q(s, a)
+        afterstate = self.afterstate_index[state, action]
+        if afterstate < 0:
+            raise KeyError(action)
+        return float(self.q_afterstates[afterstate])
+
+    def q_s(self, state):
+        # Q(s)
+        policy_s = {}
+        for key, value in enumerate(self.afterstate_index[state].tolist()):
+            if value >= 0:
+                policy_s[key] = float(self.q_afterstates[value])
+        return policy_s
+
+    def argmax_action(self, state, valid_actions):
+        valid_q = self.q_afterstates.take(self._valid_index(state, valid_actions))
+        return valid_actions[valid_q.argmax()]
+
+    def max_q(self, state, valid_actions):
+        if not valid_actions:
+            return 0
+        return self.q_afterstates.take(self._valid_index(state, valid_actions)).max()
+
+    def update(self, *data):
+        # Q-learning
+        state, action, reward, next_state, valid_next_actions = data
+
+        afterstate = self.afterstate_index[state, action]
+        if afterstate < 0:
+            raise KeyError(action)
+        q = self.q_afterstates[afterstate]
+
+        max_q = self.max_q(next_state, valid_next_actions)
+
+        self.q_afterstates[afterstate] += self.alpha * (reward + self.gamma*max_q - q)
+
+    def _valid_index(self, state, valid_actions):
+        # valid_actionsのQ tableでの位置 (-1のまま引くと最後の位置を読んでしまうので、不可能な行動があればKeyError)
+        index = self.afterstate_index[state].take(valid_actions)
+        i = index.argmin()  # minより速い
+        if index[i] < 0:
+            raise KeyError(valid_actions[i])
+        return index
+
+    def _slot_index(self, after_states, afterstates):
+        # afterstatesのそれぞれにQ tableの位置を割り当てる
+        slot_index = np.full(len(after_states), -1, dtype=np.int32)
+        slot_index[afterstates] = np.arange(len(afterstates), dtype=np.int32)
+        return slot_index
+
+    def save(self, path, **info):
+        if self.initial_code is not None:
+            info['initial_code'] = self.initial_code
+        super().save(path, **info)
+
+    def load(self, path):
+        q_afterstates = self.convert_q_afterstates(self._load(path))
+        if self._attached:
+            # 共有しているQ tableをその場で書き換える
+            self.q_afterstates[:] = q_afterstates
+        else:
+            self.q_afterstates = q_afterstates
+
+    def convert_q_afterstates(self, q_afterstates):
+        # 状態コードごとのQ table(QAfterStateAgentなどで保存したもの)も使える
+        q_afterstates = np.asarray(q_afterstates, dtype=self.q_afterstates.dtype)
+        if len(q_afterstates) == len(self.slot_index) and len(q_afterstates) != len(self.q_afterstates):
+            q_afterstates = q_afterstates[self.afterstate_codes]
+        if len(q_afterstates) != len(self.q_afterstates):
+            raise checkpoint.CheckpointError('Q table has {} entries, expected {}'.format(
+                len(q_afterstates), len(self.q_afterstates)))
+        return q_afterstates
+
+    def reload(self, path, variant=None):
+        if self._attached:
+            raise ValueError('cannot swap a shared Q table')
+        super().reload(path, variant)
+
+    def full_q_afterstates(self):
+        # 状態コードごとのQ table (QAfterStateAgentなどで使える形, Q tableに無いafterstateは0)
+        q_afterstates = np.zeros(len(self.slot_index), dtype=self.q_afterstates.dtype)
+        stored = self.slot_index >= 0
+        q_afterstates[stored] = self.q_afterstates[self.slot_index[stored]]
+        return q_afterstates
+
+    def create_shared_memory(self, name=None):
+        # Q tableを共有メモリに移し、共有メモリの名前を返す
+        # 他のプロセスはattach_shared_memoryで同じQ tableを参照できる
+        self.detach()
+        shm = shared_memory.SharedMemory(name=name, create=True, size=self.q_afterstates.nbytes)
+        q_afterstates = np.ndarray(self.q_afterstates.shape, dtype=self.q_afterstates.dtype, buffer=shm.buf)
+        q_afterstates[:] = self.q_afterstates
+
+        self._attach(q_afterstates, shm, True)
+        return shm.name
+
+    def attach_shared_memory(self, name):
+        # 共有メモリのQ tableを(コピーせずに)参照する
+        self.detach()
+        shm = shared_memory.SharedMemory(name=name)
+        if shm.size < self.q_afterstates.nbytes:
+            shm.close()
+            raise ValueError('shared memory {} is too small for the Q table'.format(name))
+        q_afterstates = np.ndarray(self.q_afterstates.shape, dtype=self.q_afterstates.dtype, buffer=shm.buf)
+
+        self._attach(q_afterstates, shm, False)
+
+    def attach_file(self, path, writable=False, offset=0):
+        # ファイルに保存されたQ tableの生の配列をmmapで参照する
+        # writable=Trueなら更新はそのままファイルに書き込まれる
+        self.detach()
+        q_afterstates = np.memmap(path, dtype=self.q_afterstates.dtype, mode='r+' if writable else 'r',
+                                  offset=offset, shape=self.q_afterstates.shape)
+
+        self._attach(q_afterstates, None, False)
+
+    def create_file(self, path):
+        # Q tableをファイルに書き出し、そのファイルを書き込み可能で参照する
+        self.q_afterstates.tofile(path)
+        self.attach_file(path, writable=True)
+
+    def attach_checkpoint(self, path, writable=False):
+        # チェックポイントのQ tableをmmapで参照する
+        header = checkpoint.read_header(path)
+        if header is None:
+            raise checkpoint.CheckpointError('not a checkpoint: {}'.format(path))
+        if header.get('delta'):
+            raise checkpoint.CheckpointError('delta checkpoint cannot be mapped: {}'.format(path))
+        if tuple(header['shape']) != self.q_afterstates.shape or np.dtype(header['dtype']) != self.q_afterstates.dtype:
+            raise checkpoint.CheckpointError('checkpoint {} has shape {} and dtype {}, expected {} and {}'.format(
+                path, tuple(header['shape']), header['dtype'], self.q_afterstates.shape, self.q_afterstates.dtype.str))
+
+        self.attach_file(path, writable, header['offset'])
+
+    def detach(self):
+        # 共有をやめて、その時点のQ tableを手元にコピーする
+        # 共有メモリを作ったエージェントなら共有メモリを削除する
+        if not self._attached:
+            return
+
+        self.q_afterstates = np.array(self.q_afterstates)
+        if self._shared_memory is not None:
+            self._shared_memory.close()
+            if self._shared_memory_owner:
+                self._shared_memory.unlink()
+
+        self._shared_memory = None
+        self._shared_memory_owner = False
+        self._attached = False
+
+    def _attach(self, q_afterstates, shm, owner):
+        self.q_afterstates = q_afterstates
+        self._shared_memory = shm
+        self._shared_memory_owner = owner
+        self._attached = True
+
+
+class SymmetricArrayQAfterStateAgent(ArrayQAfterStateAgent):
+    # 盤面の対称変換(回転と鏡映)で移り合うafterstateを同一視してQを共有するArrayQAfterStateAgent
+    # Q tableは対称な状態の代表(state_tables.StateTables.canonical)ごとに持つので約1/8の大きさになる
+    # after_statesはstate_tables.AfterstateTable
+    def _slot_index(self, after_states, afterstates):
+        # 到達できる状態は対称変換で閉じているので、代表のコードもafterstatesに含まれる
+        canonical = np.frombuffer(after_states.tables.canonical, dtype=np.int32)
+        codes = np.unique(canonical[afterstates])
+        position = np.full(len(after_states), -1, dtype=np.int32)
+        position[codes] = np.arange(len(codes), dtype=np.int32)
+
+        slot_index = np.full(len(after_states), -1, dtype=np.int32)
+        slot_index[afterstates] = position[canonical[afterstates]]
+        return slot_index
+
+    def save(self, path, **info):
+        super().save(path, symmetric=True, **info)
+
+
+def _afterstate_table(after_states):
+    # StateTablesや平坦な配列(offsets, actions, afterstates)をstate_tables.AfterstateTableにする
+    if isinstance(after_states, state_tables.StateTables):
+        return after_states.afterstates
+    if isinstance(after_states, tuple):
+        return state_tables.AfterstateTable(*after_states)
+    return after_states
+
+
+def dense_afterstates(after_states, n_actions=None):
+    # 状態, 行動の対とafterstateの対応を(状態数, 行動数)のint32配列にする
+    # 不可能な行動は-1
+    # after_statesはArrayQAfterStateAgentと同じものを使える
+    after_states = _afterstate_table(after_states)
+    if hasattr(after_states, 'offsets'):
+        # state_tables.AfterstateTableなら平坦な配列から直接作る
+        offsets = np.frombuffer(after_states.offsets, dtype=np.int32)
+        actions = np.frombuffer(after_states.actions, dtype=np.int32)
+        values = np.frombuffer(after_states.afterstates, dtype=np.int32)
+        states = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    else:
+        states, actions, values = [], [], []
+        for state, sub in enumerate(after_states):
+            for action, value in sub.items():
+                states.append(state)
+                actions.append(action)
+                values.append(value)
+
+    if n_actions is None:
+        n_actions = int(max(actions)) + 1 if len(actions) else 0
+
+    index = np.full((len(after_states), n_actions), -1, dtype=np.int32)
+    index[states, actions] = values
+    return index
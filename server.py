@@ -0,0 +1,300 @@
+import asyncio
+import collections
+import json
+import random
+import time
+
+import numpy as np
+
+import reinforcement
+import state_tables
+
+
+# 学習したエージェントの手を返すサーバー
+# TCPで1行1つのJSONのリクエストを受け取り、1行1つのJSONで返す(1つの接続で続けて送ってよい)
+#
+#   リクエスト: {"id": 1, "variant": "TicTacToeState", "state": 0, "hints": true}
+#   レスポンス: {"id": 1, "action": 0, "hints": [[0, 0.12], [1, 0.03], ...]}
+#
+# variantはエージェントが1つだけなら省略できる
+# hintsを指定すると可能な行動とそのQの対も返す
+# {"id": 2, "stats": true}なら応答時間の統計を返す(stats参照)
+# エラーの場合は{"id": 1, "error": "..."}
+#
+# 届いたリクエストはキューに入れ、max_delay秒待って溜まった分(最大max_batch個)を
+# エージェントごとにNumPyでまとめて計算する
+# レスポンスの順番はリクエストと同じとは限らないので、idで対応を取ること
+
+
+class MoveServer:
+    def __init__(self, agents, max_batch=256, max_delay=0.0005, n_latencies=100000):
+        self.agents = agents  # variant(状態クラス名) -> ArrayQAfterStateAgent
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+
+        self.latencies = collections.deque(maxlen=n_latencies)  # 直近のリクエストの応答時間(秒)
+        self.n_requests = 0
+        self.n_batches = 0
+
+        self._queue = None
+        self._server = None
+        self._batcher = None
+
+    async def start(self, host='127.0.0.1', port=8765):
+        # 待ち受けを始めて、実際のアドレスを返す(port=0なら空いているポート)
+        self._queue = asyncio.Queue()
+        self._batcher = asyncio.create_task(self._run_batches())
+        self._server = await asyncio.start_server(self._handle, host, port)
+        return self._server.sockets[0].getsockname()[:2]
+
+    async def close(self):
+        self._server.close()
+        await self._server.wait_closed()
+        self._batcher.cancel()
+        try:
+            await self._batcher
+        except asyncio.CancelledError:
+            pass
+
+    def stats(self):
+        # 直近のリクエストの応答時間(ミリ秒)の中央値と99パーセンタイルなど
+        # 応答時間はリクエストの行を読んでからレスポンスを書き込むまで
+        latencies = np.array(self.latencies) * 1000
+        return {
+            'requests': self.n_requests,
+            'batches': self.n_batches,
+            'p50_ms': float(np.percentile(latencies, 50)) if len(latencies) else None,
+            'p99_ms': float(np.percentile(latencies, 99)) if len(latencies) else None,
+        }
+
+    async def _handle(self, reader, writer):
+        # 1つの接続のリクエストを読んでキューに入れる
+        # レスポンスは_run_batchesが書き込む
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                start = time.perf_counter()
+
+                try:
+                    request = json.loads(line)
+                except ValueError:
+                    request = None
+                if not isinstance(request, dict):
+                    writer.write(b'{"error": "invalid request"}\n')
+                else:
+                    self._queue.put_nowait((request, writer, start))
+
+                await writer.drain()
+        except (ConnectionError, asyncio.LimitOverrunError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _run_batches(self):
+        queue = self._queue
+        while True:
+            batch = [await queue.get()]
+            await asyncio.sleep(self.max_delay)  # 他のリクエストが届くのを少し待つ
+            while len(batch) < self.max_batch and not queue.empty():
+                batch.append(queue.get_nowait())
+
+            requests = [request for request, _, _ in batch]
+            try:
+                responses = self._process(requests)
+            except Exception:
+                # 原因のリクエストだけエラーを返し、他のリクエストには普通に答える
+                responses = [self._process_one(request) for request in requests]
+            self.n_requests += len(batch)
+            self.n_batches += 1
+
+            for (_, writer, start), response in zip(batch, responses):
+                if not writer.is_closing():
+                    writer.write(json.dumps(response).encode('utf-8') + b'\n')
+                self.latencies.append(time.perf_counter() - start)
+
+    def _process_one(self, request):
+        try:
+            return self._process([request])[0]
+        except Exception as e:
+            return {'id': request.get('id'), 'error': 'internal error: {!r}'.format(e)}
+
+    def _process(self, requests):
+        # リクエストのリストに対するレスポンスのリストを返す
+        responses = []
+        by_variant = {}  # variant -> [(レスポンス, 状態コード, ヒントを返すか)]
+        for request in requests:
+            response = {'id': request.get('id')}
+            responses.append(response)
+
+            if request.get('stats'):
+                response.update(self.stats())
+                continue
+
+            variant = request.get('variant')
+            if variant is None and len(self.agents) == 1:
+                variant = next(iter(self.agents))
+            state = request.get('state')
+
+            if not isinstance(variant, str) or variant not in self.agents:
+                response['error'] = 'unknown variant: {}'.format(variant)
+            elif (not isinstance(state, int) or isinstance(state, bool)
+                  or not 0 <= state < len(self.agents[variant].afterstate_index)):
+                response['error'] = 'invalid state: {}'.format(state)
+            else:
+                by_variant.setdefault(variant, []).append((response, state, bool(request.get('hints'))))
+
+        for variant, items in by_variant.items():
+            agent = self.agents[variant]
+            index = agent.afterstate_index[[state for _, state, _ in items]]
+            legal = index >= 0
+            q = np.where(legal, agent.q_afterstates[index], -np.inf)
+            actions = q.argmax(axis=1)  # Qが同じ値なら番号の小さい行動(QAfterStateAgentと同じ)
+
+            for (response, state, hints), action, legal_s, q_s in zip(items, actions.tolist(), legal, q):
+                if not legal_s[action]:
+                    response['error'] = 'no valid action: {}'.format(state)
+                    continue
+                response['action'] = action
+                if hints:
+                    response['hints'] = [[a, float(q_s[a])] for a in np.flatnonzero(legal_s).tolist()]
+
+        return responses
+
+
+def load_agent(state_cls, path):
+    # チェックポイントを読み込んだArrayQAfterStateAgentを返す
+    agent = reinforcement.ArrayQAfterStateAgent(state_tables.get_tables(state_cls))
+    agent.reload(path, state_cls.__name__)
+    return agent
+
+
+async def serve(agents, host='127.0.0.1', port=8765, report_interval=10):
+    # 止めるまでリクエストを受け付け、report_interval秒ごとに統計を表示する
+    server = MoveServer(agents)
+    host, port = await server.start(host, port)
+    print('serving {} on {}:{}'.format(', '.join(agents), host, port))
+    try:
+        n_requests = 0
+        while True:
+            await asyncio.sleep(report_interval)
+            if server.n_requests != n_requests:
+                n_requests = server.n_requests
+                print(server.stats())
+    finally:
+        await server.close()
+
+
+async def check_errors(host, port, variant, state):
+    # 不正なリクエストの後でも、同じ接続と他の接続のリクエストに答え続けるかを確かめる
+    # 答えなくなっていればRuntimeError
+    bad_requests = [
+        b'not json\n',
+        b'[1, 2]\n',
+        json.dumps({'id': 1, 'variant': ['x'], 'state': state}).encode('utf-8') + b'\n',
+        json.dumps({'id': 2, 'variant': {'a': 1}, 'state': state}).encode('utf-8') + b'\n',
+        json.dumps({'id': 3, 'variant': variant, 'state': 'x'}).encode('utf-8') + b'\n',
+        json.dumps({'id': 4, 'variant': variant, 'state': -1}).encode('utf-8') + b'\n',
+    ]
+    good_request = json.dumps({'id': 5, 'variant': variant, 'state': state}).encode('utf-8') + b'\n'
+
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for line in bad_requests:
+            writer.write(line)
+            response = json.loads(await asyncio.wait_for(reader.readline(), 5))
+            if 'error' not in response:
+                raise RuntimeError('no error for {!r}: {}'.format(line, response))
+
+        writer.write(good_request)
+        response = json.loads(await asyncio.wait_for(reader.readline(), 5))
+        if 'action' not in response:
+            raise RuntimeError('no action after bad requests: {}'.format(response))
+    finally:
+        writer.close()
+
+    # 別の接続からも答えが返る
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write(good_request)
+        response = json.loads(await asyncio.wait_for(reader.readline(), 5))
+        if 'action' not in response:
+            raise RuntimeError('no action on a new connection: {}'.format(response))
+    finally:
+        writer.close()
+
+
+async def load_test(host, port, variant, states, n_clients=100, n_requests=1000):
+    # n_clients個の接続から、それぞれ応答を待ってから次のリクエストを送ることをn_requests回繰り返す
+    # 状態はstatesからランダムに選ぶ
+    # 戻り値: クライアント側で測った応答時間(秒)の配列
+    async def client():
+        reader, writer = await asyncio.open_connection(host, port)
+        latencies = []
+        try:
+            for i in range(n_requests):
+                request = {'id': i, 'variant': variant, 'state': random.choice(states), 'hints': True}
+                start = time.perf_counter()
+                writer.write(json.dumps(request).encode('utf-8') + b'\n')
+                response = json.loads(await reader.readline())
+                latencies.append(time.perf_counter() - start)
+                if 'error' in response:
+                    raise RuntimeError(response['error'])
+        finally:
+            writer.close()
+        return latencies
+
+    results = await asyncio.gather(*(client() for _ in range(n_clients)))
+    return np.concatenate(results)
+
+
+if __name__ == '__main__':
+    import sys
+
+    import solver
+    from tic_tac_toe import TicTacToeState
+    from tic_tac_toe_reverse import TicTacToeReverseState
+
+    # python server.py [port]: サーバーを起動する(Q tableが更新されたら読み込み直す)
+    # python server.py [port] bench: 同じプロセスでサーバーを起動して負荷をかけ、応答時間を表示する
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8765
+    bench = len(sys.argv) > 2 and sys.argv[2] == 'bench'
+
+    paths = {
+        TicTacToeState: 'save/tic_tac_toe_q',
+        TicTacToeReverseState: 'save/tic_tac_toe_reverse_q',
+    }
+    agents = {state_cls.__name__: load_agent(state_cls, path) for state_cls, path in paths.items()}
+
+    if not bench:
+        watchers = [agents[state_cls.__name__].watch(path, state_cls.__name__) for state_cls, path in paths.items()]
+        try:
+            asyncio.run(serve(agents, port=port))
+        except KeyboardInterrupt:
+            pass
+        for watcher in watchers:
+            watcher.close()
+        sys.exit()
+
+    async def main():
+        server = MoveServer(agents)
+        host, actual_port = await server.start(port=port)
+        try:
+            await check_errors(host, actual_port, TicTacToeState.__name__, 0)
+            print('bad requests: ok')
+
+            for state_cls, initial_code in ((TicTacToeState, 0), (TicTacToeReverseState, 3 ** 9)):
+                states = solver.solve(state_cls, initial_code).reachable.tolist()
+                start = time.perf_counter()
+                latencies = await load_test(host, actual_port, state_cls.__name__, states) * 1000
+                elapsed = time.perf_counter() - start
+
+                print('{}: {:.0f} requests/sec, p50 {:.3f} ms, p99 {:.3f} ms (client)'.format(
+                    state_cls.__name__, len(latencies) / elapsed,
+                    np.percentile(latencies, 50), np.percentile(latencies, 99)))
+            print('server:', server.stats())
+        finally:
+            await server.close()
+
+    asyncio.run(main())
@@ -0,0 +1,155 @@
+import array
+import hashlib
+import os
+import random
+
+import reinforcement
+import state_tables
+
+
+# ゲームの完全解析
+# 全ての状態について、手番のプレイヤー(x)から見た最善手順での結果(ゲーム理論値)を求める
+#   1: 勝ち, 0: 引き分け, -1: 負け
+# 反転版のパス(行動9)も他の行動と同じように扱う(2回続けてパスはできないので、同じ状態には戻らない)
+
+SOLVER_VERSION = 1  # 解析の内容を変えたら上げる
+
+NO_VALUE = -2  # 可能な行動の無い状態(終了した状態やあり得ない状態)
+
+
+class Solution:
+    # value[code]: 状態のゲーム理論値 (可能な行動が無ければNO_VALUE)
+    # reachable: 初期状態から到達できる、可能な行動のある状態のコード
+    def __init__(self, state_cls, tables, value, reachable):
+        self.state_cls = state_cls
+        self.tables = tables
+        self.value = value
+        self.reachable = reachable
+
+    def afterstate_value(self, afterstate):
+        # 行動した側から見たafterstateのゲーム理論値
+        judge = self.tables.judge[afterstate]
+        if judge == 0:
+            return -self.value[self.tables.reversed[afterstate]]
+        return 1 if judge == 1 else -1 if judge == 2 else 0
+
+    def action_values(self, state):
+        # 可能な行動ごとのゲーム理論値
+        return {action: self.afterstate_value(afterstate)
+                for action, afterstate in self.tables.afterstates[state].items()}
+
+    def optimal_actions(self, state):
+        # 最善の行動のリスト
+        values = self.action_values(state)
+        best = self.value[state]
+        return [action for action, value in values.items() if value == best]
+
+
+class PerfectAgent(reinforcement.Agent):
+    # 常に最善の行動を選ぶエージェント
+    # 最善の行動が複数あればrandom_tie=Trueならランダムに、Falseなら番号の小さい行動を選ぶ
+    def __init__(self, solution, random_tie=False):
+        self.solution = solution
+        self.random_tie = random_tie
+
+    def policy(self, state, action):
+        actions = self.solution.optimal_actions(state)
+        if self.random_tie:
+            return 1 / len(actions) if action in actions else 0
+        return 1 if action == actions[0] else 0
+
+    def select_action(self, state, valid_actions):
+        actions = self.solution.optimal_actions(state)
+        return random.choice(actions) if self.random_tie else actions[0]
+
+    def update(self, *data):
+        pass
+
+
+def solve(state_cls, initial_code, path=None, rebuild=False):
+    # 解析結果をキャッシュから読み込む
+    # 無いか古ければ解析して保存する
+    # 到達できる状態は初期状態ごとに違うので、キャッシュも初期状態ごとに分ける
+    tables = state_tables.get_tables(state_cls)
+    if path is None:
+        path = os.path.join(state_tables.CACHE_DIR, '{}.{}.solution.bin'.format(state_cls.__name__, initial_code))
+
+    fp = hashlib.sha256(state_tables.fingerprint(state_cls)
+                        + '{} {}'.format(SOLVER_VERSION, initial_code).encode('utf-8')).digest()
+    arrays = None if rebuild else state_tables.load_tables(path, fp)
+    if arrays is None:
+        arrays = {
+            'value': solve_values(tables),
+            'reachable': reachable_states(tables, initial_code),
+        }
+        try:
+            state_tables.save_tables(path, fp, arrays)
+        except OSError:
+            pass
+
+    return Solution(state_cls, tables, arrays['value'], arrays['reachable'])
+
+
+def solve_values(tables):
+    # 全ての状態のゲーム理論値をメモ化した再帰で求める
+    afterstates = tables.afterstates
+    judge_table = tables.judge
+    reversed_table = tables.reversed
+
+    value = array.array('i', [NO_VALUE]) * len(afterstates)
+
+    def negamax(state):
+        if value[state] == NO_VALUE:
+            best = -1
+            for afterstate in afterstates[state].values():
+                judge = judge_table[afterstate]
+                if judge == 0:
+                    v = -negamax(reversed_table[afterstate])
+                else:
+                    v = 1 if judge == 1 else -1 if judge == 2 else 0
+                if v > best:
+                    best = v
+                    if best == 1:
+                        break
+            value[state] = best
+        return value[state]
+
+    # 1手ごとに盤面が埋まるかパスなので、再帰の深さは高々20程度
+    for state, sub in enumerate(afterstates):
+        if sub:
+            negamax(state)
+
+    return value
+
+
+def reachable_states(tables, initial_code):
+    # 初期状態から到達できる、可能な行動のある状態
+    valid_mask = tables.valid_mask
+    states, _ = tables.reachable(initial_code)
+    return array.array('i', [s for s in states if valid_mask[s]])
+
+
+def score(agent, solution):
+    # 到達できる状態のうち、エージェントの貪欲な行動が最善の行動である割合
+    valid_actions = solution.tables.valid_actions
+    n_optimal = 0
+    for state in solution.reachable:
+        action = agent.argmax_action(state, valid_actions(state))
+        if solution.afterstate_value(solution.tables.afterstates[state][action]) == solution.value[state]:
+            n_optimal += 1
+
+    return n_optimal / len(solution.reachable)
+
+
+if __name__ == '__main__':
+    from tic_tac_toe import TicTacToeState
+    from tic_tac_toe_reverse import TicTacToeReverseState
+
+    for state_cls, initial_code, path in ((TicTacToeState, 0, 'save/tic_tac_toe_q'),
+                                          (TicTacToeReverseState, 3 ** 9, 'save/tic_tac_toe_reverse_q')):
+        solution = solve(state_cls, initial_code)
+        agent = reinforcement.QAfterStateAgent(state_cls.afterstates())
+        agent.load(path)
+
+        print('{}: value {}, {} reachable states, {} optimal: {:.4f}'.format(
+            state_cls.__name__, solution.value[initial_code], len(solution.reachable), path, score(agent, solution)))
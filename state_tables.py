@@ -0,0 +1,242 @@
+import array
+import hashlib
+import inspect
+import mmap
+import os
+import struct
+import sys
+
+import bitboard
+
+
+# 状態コードで引くテーブルをまとめてキャッシュする
+# テーブルは全てint32の平坦な配列で、1つのファイルに並べて保存し、
+# 次回以降はmmapで読み込むだけにする
+
+TABLE_VERSION = 4  # テーブルの構成を変えたら上げる
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache')
+
+_MAGIC = b'QTTTABLE'
+_HEADER = struct.Struct('<8s32sI')  # magic, fingerprint, テーブル数
+_ENTRY = struct.Struct('<16sQQ')  # 名前, オフセット(byte), 要素数
+
+_loaded = {}  # プロセス内で読み込み済みのテーブル
+
+# 行動のビット(0-8: マス, 9: パス)から行動のリストを引く
+_ACTIONS = tuple(tuple(a for a in range(10) if mask >> a & 1) for mask in range(1 << 10))
+
+N_SYMMETRIES = len(bitboard.SYMMETRIES)
+
+
+class AfterstateTable(dict):
+    # 状態, 行動の対とafterstateの対応
+    # 従来通りtable[code][action]で引けて、lenと順番に取り出すのもdictのlistと同じ
+    # 各状態のdictは初めて引いたときに平坦な配列から作る(読み込むだけならdictを作らない)
+    # offsets[code]からoffsets[code + 1]までがcodeの行動とafterstate
+    # tablesは元のStateTables (canonical, reachableなどを引くのに使う)
+    def __init__(self, offsets, actions, afterstates, tables=None):
+        super().__init__()
+
+        self.offsets = offsets
+        self.actions = actions
+        self.afterstates = afterstates
+        self.tables = tables
+
+    def __missing__(self, code):
+        if not 0 <= code < len(self):
+            raise IndexError('state code out of range: {}'.format(code))
+        start = self.offsets[code]
+        end = self.offsets[code + 1]
+        sub = self[code] = dict(zip(self.actions[start:end], self.afterstates[start:end]))
+        return sub
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __iter__(self):
+        return (self[code] for code in range(len(self)))
+
+
+class StateTables:
+    # 状態コードで引くテーブル
+    # judge[code]: 状態の判定(state.judge()と同じ)
+    # valid_mask[code]: 可能な行動のビット
+    # reversed[code]: x <=> oを反転させた状態のコード
+    # canonical[code]: 8通りの対称変換で移した状態のうちコードが最小のもの(対称な状態の代表)
+    # offsets, actions, afterstates: AfterstateTable参照
+    def __init__(self, arrays):
+        self.arrays = arrays  # 名前 -> int32の配列
+
+        self.judge = arrays['judge']
+        self.valid_mask = arrays['valid_mask']
+        self.reversed = arrays['reversed']
+        self.canonical = arrays['canonical']
+
+        self._afterstates = None
+        self._reachable = {}
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def valid_actions(self, code):
+        # 可能な全てのactionを返す
+        return list(_ACTIONS[self.valid_mask[code]])
+
+    @property
+    def afterstates(self):
+        if self._afterstates is None:
+            self._afterstates = AfterstateTable(self['offsets'], self['actions'], self['afterstates'], self)
+        return self._afterstates
+
+    def reachable(self, initial_code):
+        # 初期状態から到達できる状態と、そこから行動して得られるafterstate(終了した状態を含む)
+        # どちらもコードの昇順のint32の配列
+        if initial_code not in self._reachable:
+            offsets = self['offsets']
+            afterstates = self['afterstates']
+
+            seen = {initial_code}
+            stack = [initial_code]
+            after = set()
+            while stack:
+                state = stack.pop()
+                for i in range(offsets[state], offsets[state + 1]):
+                    afterstate = afterstates[i]
+                    after.add(afterstate)
+                    if self.judge[afterstate] == 0:
+                        next_state = self.reversed[afterstate]
+                        if next_state not in seen:
+                            seen.add(next_state)
+                            stack.append(next_state)
+
+            self._reachable[initial_code] = (array.array('i', sorted(seen)), array.array('i', sorted(after)))
+        return self._reachable[initial_code]
+
+
+def fingerprint(state_cls):
+    # 状態の符号化が変わったらキャッシュを作り直すための識別子
+    # 符号化と行動の処理はbitboardにあるので、そのソースも含める
+    sources = []
+    for obj in (state_cls, bitboard):
+        try:
+            sources.append(inspect.getsource(obj))
+        except (OSError, TypeError):
+            sources.append('')
+
+    h = hashlib.sha256()
+    for s in (str(TABLE_VERSION), sys.byteorder, state_cls.__module__, state_cls.__qualname__,
+              str(getattr(state_cls, 'ENCODING_VERSION', 0)), str(state_cls.N_CODES), *sources):
+        h.update(s.encode('utf-8'))
+        h.update(b'\0')
+    return h.digest()
+
+
+def cache_path(state_cls):
+    return os.path.join(CACHE_DIR, '{}.bin'.format(state_cls.__name__))
+
+
+def build_tables(state_cls):
+    # 全ての状態コードについてテーブルを計算する
+    judge = array.array('i')
+    valid_mask = array.array('i')
+    reversed_code = array.array('i')
+    canonical = array.array('i')
+
+    for code in range(state_cls.N_CODES):
+        s = state_cls(code)
+        judge.append(s.judge())
+        valid_mask.append(sum(1 << a for a in s.valid_actions()))
+        reversed_code.append(s.reverse().code())
+
+        canonical.append(min(s.transform(t).code() for t in range(N_SYMMETRIES)))
+
+    offsets = array.array('i', [0])
+    actions = array.array('i')
+    afterstates = array.array('i')
+
+    for sub in state_cls.build_afterstates():
+        actions.extend(sub.keys())
+        afterstates.extend(sub.values())
+        offsets.append(len(actions))
+
+    return {
+        'judge': judge,
+        'valid_mask': valid_mask,
+        'reversed': reversed_code,
+        'canonical': canonical,
+        'offsets': offsets,
+        'actions': actions,
+        'afterstates': afterstates,
+    }
+
+
+def save_tables(path, fp, arrays):
+    # 一時ファイルに書いてから置き換える
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    offset = _HEADER.size + _ENTRY.size * len(arrays)
+    entries = []
+    for name, a in arrays.items():
+        entries.append(_ENTRY.pack(name.encode('ascii'), offset, len(a)))
+        offset += a.itemsize * len(a)
+
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(_HEADER.pack(_MAGIC, fp, len(arrays)))
+        for entry in entries:
+            f.write(entry)
+        for a in arrays.values():
+            a.tofile(f)
+    os.replace(tmp_path, path)
+
+
+def load_tables(path, fp):
+    # キャッシュが無いか古い場合はNoneを返す
+    try:
+        with open(path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+
+    if len(mm) < _HEADER.size:
+        return None
+    magic, file_fp, n = _HEADER.unpack_from(mm, 0)
+    if magic != _MAGIC or file_fp != fp:
+        return None
+
+    buf = memoryview(mm)
+    arrays = {}
+    for i in range(n):
+        name, offset, length = _ENTRY.unpack_from(mm, _HEADER.size + _ENTRY.size * i)
+        if offset + 4 * length > len(mm):
+            return None
+        arrays[name.rstrip(b'\0').decode('ascii')] = buf[offset:offset + 4 * length].cast('i')
+
+    return arrays
+
+
+def get_tables(state_cls, path=None, rebuild=False):
+    # キャッシュからテーブルを読み込む
+    # 無いか状態の符号化が変わっていれば作り直して保存する
+    if path is None:
+        path = cache_path(state_cls)
+
+    key = (state_cls, path)
+    if not rebuild and key in _loaded:
+        return _loaded[key]
+
+    fp = fingerprint(state_cls)
+    arrays = None if rebuild else load_tables(path, fp)
+    if arrays is None:
+        arrays = build_tables(state_cls)
+        try:
+            save_tables(path, fp, arrays)
+        except OSError:
+            pass  # 保存できなくても計算したテーブルはそのまま使える
+        else:
+            arrays = load_tables(path, fp) or arrays
+
+    _loaded[key] = StateTables(arrays)
+    return _loaded[key]
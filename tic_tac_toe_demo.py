@@ -1,3 +1,5 @@
+import checkpoint
+import policy
 from tic_tac_toe import *
 
 
@@ -136,15 +138,14 @@ class Game:
 
     def hint(self):
         # ヒント表示
-        # Qを100倍して表示する
-        q_s = agent.q_s(self.env.state.code())
+        # Qの大きい順に、Qを100倍して表示する
         valid_q_s = {}
-        for valid_action in self.env.valid_actions():
-            valid_q_s[(valid_action % 3, valid_action // 3)] = q_s[valid_action] * 100
+        for valid_action, q in self.agent.hints(self.env.state.code()):
+            valid_q_s[(valid_action % 3, valid_action // 3)] = q * 100
 
         format = '{} {}: {:>6.2f}'
 
-        argmax = max(valid_q_s, key=valid_q_s.get)
+        argmax = next(iter(valid_q_s))
 
         for key, value in valid_q_s.items():
             s = format.format(key[0], key[1], value)
@@ -161,15 +162,19 @@ class Game:
 
 if __name__ == '__main__':
     # 環境とエージェントの初期化
-    # explore=Trueならたまに間違える
     env = TicTacToeEnvironment()
-    agent = reinforcement.QAfterStateAgent(TicTacToeState.afterstates(), explore=False)
 
-    # Q tableを読み込む
-    agent.load('save/tic_tac_toe_q')
+    # Q tableから書き出した方策表を読み込む(無ければ書き出す)
+    agent = policy.load_policy(TicTacToeState, 'save/tic_tac_toe_q')
 
     game = Game(env, agent)
 
+    # Q tableが更新されたら方策表を作り直して入れ替える
+    def reload(path):
+        game.agent = policy.load_policy(TicTacToeState, path)
+
+    watcher = checkpoint.CheckpointWatcher('save/tic_tac_toe_q', reload)
+
     result = [0, 0, 0, 0]
     while True:
         result[game() - 1] += 1  # ゲームを実行して結果を保存
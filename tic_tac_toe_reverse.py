@@ -1,24 +1,28 @@
-import copy
+import time
 
+import bitboard
+import engine
 import reinforcement
+import state_tables
 
 
 class TicTacToeReverseEnvironment(reinforcement.Environment):
     def __init__(self):
         super().__init__()
 
+        self.tables = state_tables.get_tables(TicTacToeReverseState)
         self.state = TicTacToeReverseState(3 ** 9)  # 1回パスした状態から開始することで初手パスを防ぐ
 
     def valid_actions(self):
         # self.stateから可能な全てのactionを返す
-        return self.state.valid_actions()
+        return self.tables.valid_actions(self.state.code())
 
     def step(self, action):
         # ゲームを1手進める
         self.state = self.state.change(action, 1)
 
         # 報酬設定
-        judge = self.state.judge()
+        judge = self.tables.judge[self.state.code()]
         reward = 1 if judge == 1 else -1 if judge == 2 else 0
 
         return reward, self.state
@@ -29,71 +33,70 @@ class TicTacToeReverseEnvironment(reinforcement.Environment):
 
 class TicTacToeReverseState:
     SYMBOL = ('_', 'x', 'o')
+    N_CODES = 2 * 3**9  # 状態コードの数
+
+    __slots__ = ('_x', '_o', '_pass_state', '_code', '_judge')
 
     def __init__(self, code=None):
         # 0: blank
         # 1: x
         # 2: o
+        # 盤面はxとoの置かれたマスのビット(bitboard参照)と状態コードで持つ
 
-        self._state = [0] * 9
-        self._pass_state = False
-        if code is not None:
-            # 整数から状態を復元する
-            self._pass_state = code // (3 ** 9)  # 0 or 1
-            code = code % 3 ** 9
+        if code is None:
+            code = 0
 
-            i = 0
-            while code > 0:
-                self._state[i] = code % 3
-                code = code // 3
-                i += 1
+        # 整数から状態を復元する
+        self._pass_state = code >= 3 ** 9
+        self._x, self._o = bitboard.decode(code % 3 ** 9)
+        self._code = code
 
         self._judge = None
 
+    @classmethod
+    def _from_bits(cls, x, o, pass_state):
+        # 盤面のビットから直接作る
+        s = cls.__new__(cls)
+        s._x = x
+        s._o = o
+        s._pass_state = pass_state
+        s._code = bitboard.BASE3[x] + 2 * bitboard.BASE3[o] + (3 ** 9 if pass_state else 0)
+        s._judge = None
+        return s
+
     def change(self, pos, state):
         # 状態を更新する
         # pos = (x, y)
         # x, y = 0, 1, 2
         if pos == 9:
-            clone = self.clone()
-            clone._pass_state = True
-            return clone
+            return self._from_bits(self._x, self._o, True)
         else:
             if isinstance(pos, tuple):
                 x, y = pos
                 pos = 3*y+x
-            clone = self.clone()
-            clone._state[pos] = state
 
             # 周囲を反転
-            clone._reverse(pos - 3)
-            clone._reverse(pos + 3)
-            if pos % 3 != 0:
-                clone._reverse(pos - 3 - 1)
-                clone._reverse(pos - 1)
-                clone._reverse(pos + 3 - 1)
-            if pos % 3 != 2:
-                clone._reverse(pos - 3 + 1)
-                clone._reverse(pos + 1)
-                clone._reverse(pos + 3 + 1)
-
-            clone._pass_state = False
-
-            return clone
-
-    def _reverse(self, pos):
-        if 0 <= pos < 9:
-            pos_state = self._state[pos]
-            if pos_state != 0:
-                self._state[pos] = 3 - pos_state
+            neighbours = bitboard.NEIGHBOURS[pos]
+            x = (self._x & ~neighbours) | (self._o & neighbours)
+            o = (self._o & ~neighbours) | (self._x & neighbours)
+
+            bit = 1 << pos
+            x &= ~bit
+            o &= ~bit
+            if state == 1:
+                x |= bit
+            elif state == 2:
+                o |= bit
+
+            return self._from_bits(x, o, False)
 
     def code(self):
         # 状態と一対一に対応する整数を返す
-        a = 1 if self._pass_state else 0
-        for i in reversed(list(range(9))):
-            a *= 3
-            a += self._state[i]
-        return a
+        return self._code
+
+    def cells(self):
+        # 各マスの状態を返す
+        return bitboard.cells(self._x, self._o)
 
     def judge(self):
         # ゲームの状態を判定する
@@ -104,35 +107,23 @@ class TicTacToeReverseState:
         # -1: impossible state
 
         if self._judge is None:
-            result = [0, 0]
-
-            self._judge_line(result, self._state[0], self._state[1], self._state[2])
-            self._judge_line(result, self._state[3], self._state[4], self._state[5])
-            self._judge_line(result, self._state[6], self._state[7], self._state[8])
-            self._judge_line(result, self._state[0], self._state[3], self._state[6])
-            self._judge_line(result, self._state[1], self._state[4], self._state[7])
-            self._judge_line(result, self._state[2], self._state[5], self._state[8])
-            self._judge_line(result, self._state[0], self._state[4], self._state[8])
-            self._judge_line(result, self._state[2], self._state[4], self._state[6])
-
-            if result[0] != 0 and result[1] != 0:
+            # 8列のどれかが揃っているかを盤面のビットから表で引く
+            x_won = bitboard.WINS[self._x]
+            o_won = bitboard.WINS[self._o]
+
+            if x_won and o_won:
                 self._judge = 3
-            elif result[0] != 0:
+            elif x_won:
                 self._judge = 1
-            elif result[1] != 0:
+            elif o_won:
                 self._judge = 2
-            elif self.list_blank():  # True if not empty
+            elif self._x | self._o != bitboard.FULL:  # 空白がある
                 self._judge = 0
             else:
                 self._judge = 3
 
         return self._judge
 
-    @staticmethod
-    def _judge_line(result, pos1, pos2, pos3):
-        if pos1 != 0 and pos1 == pos2 == pos3:
-            result[pos1 - 1] += 1
-
     def validate_gameset(self):
         # ゲーム終了を判定する
         if self._judge is None:
@@ -141,7 +132,7 @@ class TicTacToeReverseState:
 
     def list_blank(self):
         # 空白のマス(=選ぶことのできるマス)を返す
-        return [key for key, value in enumerate(self._state) if value == 0]
+        return list(bitboard.POSITIONS[bitboard.FULL & ~(self._x | self._o)])
 
     def valid_actions(self):
         # 可能な全てのactionを返す
@@ -155,26 +146,28 @@ class TicTacToeReverseState:
 
     def reverse(self):
         # 状態を反転させる(x <=> o)
-        clone = self.clone()
-        for i in range(9):
-            a = clone._state[i]
-            if a != 0:
-                clone._state[i] = 3 - a  # 1 <=> 2
-
-        return clone
+        return self._from_bits(self._o, self._x, self._pass_state)
 
     def clone(self):
-        s = self.__class__()
-        s._state = copy.deepcopy(self._state)
-        s._pass_state = self._pass_state
-        return s
+        return self._from_bits(self._x, self._o, self._pass_state)
+
+    def transform(self, t):
+        # 盤面を対称変換tで移す(bitboard.SYMMETRIES参照)
+        masks = bitboard.SYMMETRY_MASKS[t]
+        return self._from_bits(masks[self._x], masks[self._o], self._pass_state)
 
     @classmethod
     def afterstates(cls):
         # 状態, 行動の対とafterstateの対応を返す
+        # 初回に計算した結果をキャッシュし、次回以降は読み込むだけ
+        return state_tables.get_tables(cls).afterstates
+
+    @classmethod
+    def build_afterstates(cls):
+        # 状態, 行動の対とafterstateの対応を計算する
         afterstates = []
 
-        for code in range(2 * 3**9):
+        for code in range(cls.N_CODES):
             sub = {}
             s = cls(code)
 
@@ -189,8 +182,9 @@ class TicTacToeReverseState:
 
     def __str__(self):
         s = ''
+        cells = self.cells()
         for i in range(9):
-            s += TicTacToeReverseState.SYMBOL[self._state[i]]
+            s += TicTacToeReverseState.SYMBOL[cells[i]]
             if i % 3 != 2:
                 s += ' '
             elif i is not 8:
@@ -207,12 +201,18 @@ class TicTacToeReverseSelfPlay:
         self.save_path_format = save_path_format
 
         self.env = TicTacToeReverseEnvironment()
+        self.tables = self.env.tables
         self.count = 0
 
+        self.metrics = None  # metrics.TrainingMetrics (Noneなら計測しない)
+
         if self.save_path_format is not None:
-            self.agent.save(self.save_path_format.format(self.count))
+            self.save()
 
     def __call__(self):
+        stopwatch = self.metrics.stopwatch() if self.metrics is not None else None  # 時間を計るゲームならStopwatch
+        plies = 0
+
         self.env.reset()
 
         # sar_o = None
@@ -220,21 +220,34 @@ class TicTacToeReverseSelfPlay:
 
         while True:
             sar_o = sar
-
-            state = self.env.get_state()
-            action = self.agent.select_action(state.code(), self.env.valid_actions())
+            plies += 1
+
+            state = self.env.get_state().code()
+            if stopwatch is not None:
+                stopwatch.lap('state')
+            action = self.agent.select_action(state, self.env.valid_actions())
+            if stopwatch is not None:
+                stopwatch.lap('select_action')
             reward, afterstate = self.env.step(action)  # afterstateはstate_oのnext_state
+            if stopwatch is not None:
+                stopwatch.lap('step')
 
             sar = (state, action, reward)
 
+            # 状態の判定と反転は状態コードからテーブルで引く
+            after_code = afterstate.code()
+            valid_actions = self.tables.valid_actions(after_code)
+
             if sar_o is not None:
                 # 1手前の相手の手に対する報酬が得られたので、ここで学習する
                 state_o, action_o, _ = sar_o
-                self.agent.update(state_o.code(), action_o, -reward, afterstate.reverse().code(), self.env.valid_actions())
+                self.agent.update(state_o, action_o, -reward, self.tables.reversed[after_code], valid_actions)
 
-            if afterstate.validate_gameset():
+            if self.tables.judge[after_code] != 0:
                 # ゲームが終了した場合、最後の状態も評価する
-                self.agent.update(state.code(), action, reward, afterstate.code(), self.env.valid_actions())
+                self.agent.update(state, action, reward, after_code, valid_actions)
+                if stopwatch is not None:
+                    stopwatch.lap('update')
 
                 self.count += 1
 
@@ -246,27 +259,66 @@ class TicTacToeReverseSelfPlay:
 
                     # # エージェントを保存
                     if self.save_path_format is not None:
-                        self.agent.save(self.save_path_format.format(self.count))
+                        self.save()
+
+                if self.metrics is not None:
+                    self.metrics.end_games(1, plies)
 
                 return
 
+            if stopwatch is not None:
+                stopwatch.lap('update')
+
             # 反転して手番を交代する
             afterstate = afterstate.reverse()
             self.env.set_state(afterstate)
 
+    def save(self):
+        # エージェントを保存し、保存で待たされた時間を記録する
+        start = time.perf_counter()
+        self.agent.save(self.save_path_format.format(self.count), count=self.count, variant=TicTacToeReverseState.__name__)
+        if self.metrics is not None:
+            self.metrics.checkpoint_saved(time.perf_counter() - start)
+
+
+class TicTacToeReverseCodeSelfPlay(engine.CodeSelfPlay):
+    # 状態コードだけで自己対戦するTicTacToeReverseSelfPlay
+    def __init__(self, agent, save_path_format):
+        super().__init__(agent, save_path_format, TicTacToeReverseState, 3 ** 9)
+
+
+class TicTacToeReverseBatchSelfPlay(engine.BatchSelfPlay):
+    # 複数のゲームを同時に進めるTicTacToeReverseSelfPlay
+    # agentはArrayQAfterStateAgent
+    def __init__(self, agent, save_path_format, n_parallel=1024, seed=None):
+        super().__init__(agent, save_path_format, TicTacToeReverseState, 3 ** 9, n_parallel, seed)
+
 
 if __name__ == '__main__':
-    n_game = 1000000  # 学習ゲーム数
+    n_game = 1000000  # 最大の学習ゲーム数
 
     import datetime
+
+    import checkpoint
+    import convergence
+    import metrics
+
     now = datetime.datetime.now()
     save_path_format = 'save/' + now.strftime('%Y%m%d_%H%M%S') + '_tic_tac_toe_reverse_q_{}'
 
     # エージェントと学習クラスの初期化
     agent = reinforcement.QAfterStateAgent(TicTacToeReverseState.afterstates(), epsilon=0.5, explore=True)
-    selfplay = TicTacToeReverseSelfPlay(agent, save_path_format)
-
-    for _ in range(n_game):
-        selfplay()
+    agent.checkpoint_writer = checkpoint.AsyncWriter(checkpoint.DeltaWriter())  # 変化した要素だけ別スレッドで保存する
+    selfplay = TicTacToeReverseCodeSelfPlay(agent, save_path_format)
+    selfplay.metrics = metrics.TrainingMetrics(agent, hooks=[  # 10000ゲームごとに学習速度などを記録する
+        metrics.CSVSink(save_path_format.format('metrics') + '.csv'), metrics.print_record])
+    agent.checkpoint_writer.on_written = selfplay.metrics.checkpoint_written  # 別スレッドでの書き込みの時間も記録する
+
+    # 最善の行動を選ぶ状態の割合が3回続けて99.9%以上になったら打ち切る
+    monitor = convergence.ConvergenceMonitor(agent, TicTacToeReverseState, 3 ** 9, min_score=0.999)
+    n_played = convergence.train(selfplay, monitor, n_game)
+    print('{} games, converged: {}'.format(n_played, monitor.converged))
+
+    agent.checkpoint_writer.close()  # 保存が終わるまで待つ
 
     print('total time: {}'.format(datetime.datetime.now() - now))
@@ -6,15 +6,8 @@ if __name__ == '__main__':
     import matplotlib.pyplot as plt
     import numpy as np
 
-    from reinforcement import QAfterStateAgent
     from tic_tac_toe_reverse import *
 
-    env = TicTacToeReverseEnvironment()
-    afterstates = TicTacToeReverseState.afterstates()
-
-    randomAgent = QAfterStateAgent(afterstates, epsilon=1, explore=True)
-    agent = None
-
     plot_data = {
         'random': {
             'first_move_win': [],
@@ -34,26 +27,24 @@ if __name__ == '__main__':
         }
     }
 
-    step = 10000
-    n = 1000000
     test_games = 1000
 
     save_path_format = 'save/20201020_142341_tic_tac_toe_reverse_q_{}'
-    for i in range(n // step + 1):
-        prev_agent = agent
-        agent = QAfterStateAgent(afterstates)
-        agent.load(save_path_format.format(i * step))
+    counts = saved_counts(save_path_format)
 
-        log = test_game(env, agent, randomAgent, test_games)
+    # 評価は複数のプロセスで並列に行い、終わった順に受け取る
+    results = [None] * len(counts)
+    for i, log, prev_log in evaluate_checkpoints(TicTacToeReverseEnvironment, TicTacToeReverseState, save_path_format, counts, test_games):
+        results[i] = (log, prev_log)
+        print('{}/{}'.format(counts[i], counts[-1]))
+
+    for log, prev_log in results:
         for key in log:
             plot_data['random'][key].append(log[key])
 
-        if prev_agent is not None:
-            log = test_game(env, agent, prev_agent, 1)
-            for key in log:
-                plot_data['prev'][key].append(log[key])
-
-        print('{}/{}'.format(i * step, n))
+        if prev_log is not None:
+            for key in prev_log:
+                plot_data['prev'][key].append(prev_log[key])
 
     fig = plt.figure()
     ax1 = fig.add_subplot(2, 2, 1, title='vs random agent (first move)')
@@ -61,7 +52,7 @@ if __name__ == '__main__':
     ax3 = fig.add_subplot(2, 2, 3, title='vs previous agent (first move)')
     ax4 = fig.add_subplot(2, 2, 4, title='vs previous agent (second move)')
 
-    x = np.arange(0, n + 1, step)
+    x = np.array(counts)
     ax1.stackplot(x,
                   np.array(plot_data['random']['first_move_win']),
                   np.array(plot_data['random']['first_move_draw']),
@@ -71,7 +62,7 @@ if __name__ == '__main__':
                   np.array(plot_data['random']['second_move_draw']),
                   np.array(plot_data['random']['second_move_lose']))
 
-    x = np.arange(step, n + 1, step)
+    x = np.array(counts[1:])
     ax3.stackplot(x,
                   np.array(plot_data['prev']['first_move_win']),
                   np.array(plot_data['prev']['first_move_draw']),
@@ -1,3 +1,13 @@
+import multiprocessing
+import os
+import random
+import re
+
+import numpy as np
+
+import engine
+import state_tables
+from reinforcement import QAfterStateAgent, dense_afterstates
 
 
 def test_game(env, agent1, agent2, n_game=1000):
@@ -58,19 +68,187 @@ def game(env, agent1, agent2, agent1_first):
         agent1_move = not agent1_move
 
 
+def batch_test_game(env, agent1, agent2, n_game=1000, seed=None):
+    # test_gameと同じ対戦を状態コードの配列でまとめて行う
+    # 先手と後手をそれぞれn_gameゲームずつ同時に進め、test_gameと同じ形式の結果を返す
+    env.reset()
+    initial_code = env.get_state().code()
+    tables = state_tables.get_tables(type(env.get_state()))
+    judge_table = np.frombuffer(tables.judge, dtype=np.int32)
+    reversed_table = np.frombuffer(tables.reversed, dtype=np.int32)
+    transitions = dense_afterstates(tables.afterstates)
+
+    rng = np.random.default_rng(seed)
+    players = [_batch_player(agent1), _batch_player(agent2)]
+
+    state = np.full(2 * n_game, initial_code, dtype=np.int64)
+    agent1_move = np.arange(2 * n_game) < n_game  # 前半は先手, 後半は後手
+    result = np.zeros(2 * n_game, dtype=np.int64)  # 1: agent1の勝ち, -1: agent1の負け, 0: 引き分け
+    playing = np.arange(2 * n_game)
+
+    while len(playing):
+        s = state[playing]
+        moves = agent1_move[playing]
+
+        actions = np.empty(len(playing), dtype=np.int64)
+        for player, mask in zip(players, (moves, ~moves)):
+            if mask.any():
+                q_afterstates, afterstate_index, epsilon = player
+                actions[mask] = engine.select_actions(q_afterstates, afterstate_index, s[mask], epsilon, rng)
+
+        afterstate = transitions[s, actions]
+        judge = judge_table[afterstate]
+
+        winner = np.where(moves, 1, -1)
+        result[playing] = np.where(judge == 1, winner, np.where(judge == 2, -winner, 0))
+
+        # 反転して手番を交代する
+        done = judge != 0
+        state[playing] = reversed_table[afterstate]
+        agent1_move[playing] = ~moves
+        playing = playing[~done]
+
+    first, second = result[:n_game], result[n_game:]
+    return {
+        'first_move_win': int((first == 1).sum()),
+        'first_move_lose': int((first == -1).sum()),
+        'first_move_draw': int((first == 0).sum()),
+        'second_move_win': int((second == 1).sum()),
+        'second_move_lose': int((second == -1).sum()),
+        'second_move_draw': int((second == 0).sum()),
+    }
+
+
+def exact_test_game(env, agent1, agent2):
+    # test_gameの結果の期待値(各結果の確率)を、対戦せずに厳密に求める
+    # 初期状態から1手ずつ、各状態に居る確率を両エージェントの行動確率で次の状態に配っていく
+    env.reset()
+    initial_code = env.get_state().code()
+    tables = state_tables.get_tables(type(env.get_state()))
+
+    log = {}
+    for agent1_first, prefix in ((True, 'first_move_'), (False, 'second_move_')):
+        win, lose, draw = _exact_game(tables, initial_code, agent1, agent2, agent1_first)
+        log[prefix + 'win'] = win
+        log[prefix + 'lose'] = lose
+        log[prefix + 'draw'] = draw
+
+    return log
+
+
+def _exact_game(tables, initial_code, agent1, agent2, agent1_first):
+    # agent1の勝ち, 負け, 引き分けの確率
+    afterstates = tables.afterstates
+    judge_table = tables.judge
+    reversed_table = tables.reversed
+
+    win = lose = draw = 0.0
+    agent1_move = agent1_first
+    frontier = {initial_code: 1.0}  # 状態 -> その状態になる確率
+    while frontier:
+        agent = agent1 if agent1_move else agent2
+        next_frontier = {}
+        for state, p in frontier.items():
+            for action, pa in _action_probabilities(agent, state, tables.valid_actions(state)).items():
+                if pa == 0:
+                    continue
+                afterstate = afterstates[state][action]
+                judge = judge_table[afterstate]
+                if judge == 0:
+                    next_state = reversed_table[afterstate]
+                    next_frontier[next_state] = next_frontier.get(next_state, 0.0) + p * pa
+                elif judge == 3:
+                    draw += p * pa
+                elif (judge == 1) == agent1_move:
+                    win += p * pa
+                else:
+                    lose += p * pa
+
+        frontier = next_frontier
+        agent1_move = not agent1_move
+
+    return win, lose, draw
+
+
+def _action_probabilities(agent, state, valid_actions):
+    # エージェントが各行動を選ぶ確率
+    if hasattr(agent, 'argmax_action'):
+        # QAfterStateAgentのepsilon-greedy
+        epsilon = agent.epsilon if agent.explore else 0
+        probabilities = dict.fromkeys(valid_actions, epsilon / len(valid_actions))
+        probabilities[agent.argmax_action(state, valid_actions)] += 1 - epsilon
+        return probabilities
+    else:
+        return {action: agent.policy(state, action) for action in valid_actions}
+
+
+def _batch_player(agent):
+    # エージェントのQ table, 状態と行動からafterstateへの対応, epsilon
+    if hasattr(agent, 'afterstate_index'):
+        afterstate_index = agent.afterstate_index
+    else:
+        afterstate_index = dense_afterstates(agent.afterstates)
+    epsilon = agent.epsilon if agent.explore else 0
+
+    return np.asarray(agent.q_afterstates, dtype=np.float64), afterstate_index, epsilon
+
+
+def saved_counts(save_path_format):
+    # save_path_formatで保存されたチェックポイントの学習ゲーム数(昇順)
+    # 収束して学習を打ち切ることがあるので、実際にあるファイルから求める
+    prefix, suffix = save_path_format.split('{}')
+    pattern = re.compile(re.escape(os.path.basename(prefix)) + r'(\d+)' + re.escape(suffix) + '$')
+    return sorted(int(m.group(1)) for m in map(pattern.match, os.listdir(os.path.dirname(prefix) or '.')) if m)
+
+
+def evaluate_checkpoints(env_cls, state_cls, save_path_format, counts, test_games=1000, n_workers=None):
+    # チェックポイントごとにランダムなエージェントと1つ前のチェックポイントとの対戦を
+    # 複数のプロセスで並列に行い、終わった順に(番号, ランダムとの結果, 1つ前との結果)を返す
+    # チェックポイントは各プロセスで評価の直前に読み込む
+    tasks = []
+    for i, count in enumerate(counts):
+        prev_path = save_path_format.format(counts[i - 1]) if i > 0 else None
+        tasks.append((i, save_path_format.format(count), prev_path, test_games))
+
+    with multiprocessing.Pool(n_workers, initializer=_init_worker, initargs=(env_cls, state_cls)) as pool:
+        yield from pool.imap_unordered(_evaluate_checkpoint, tasks)
+
+
+_worker = {}  # 評価用プロセスの環境とエージェント
+
+
+def _init_worker(env_cls, state_cls):
+    random.seed()  # forkしたプロセス同士で乱数が同じにならないようにする
+
+    afterstates = state_cls.afterstates()
+    _worker['env'] = env_cls()
+    _worker['afterstates'] = afterstates
+    _worker['random'] = QAfterStateAgent(afterstates, epsilon=1, explore=True)
+
+
+def _evaluate_checkpoint(task):
+    i, path, prev_path, test_games = task
+    env = _worker['env']
+
+    agent = QAfterStateAgent(_worker['afterstates'])
+    agent.load(path)
+    log = batch_test_game(env, agent, _worker['random'], test_games)
+
+    prev_log = None
+    if prev_path is not None:
+        prev_agent = QAfterStateAgent(_worker['afterstates'])
+        prev_agent.load(prev_path)
+        prev_log = test_game(env, agent, prev_agent, 1)
+
+    return i, log, prev_log
+
+
 if __name__ == '__main__':
     import matplotlib.pyplot as plt
     import numpy as np
 
-    from reinforcement import QAfterStateAgent
     from tic_tac_toe import *
 
-    env = TicTacToeEnvironment()
-    afterstates = TicTacToeState.afterstates()
-
-    randomAgent = QAfterStateAgent(afterstates, epsilon=1, explore=True)
-    agent = None
-
     plot_data = {
         'random': {
             'first_move_win': [],
@@ -90,26 +268,24 @@ if __name__ == '__main__':
         }
     }
 
-    step = 10000
-    n = 1000000
     test_games = 1000
 
     save_path_format = 'save/20201015_190846_tic_tac_toe_q_{}'
-    for i in range(n // step + 1):
-        prev_agent = agent
-        agent = QAfterStateAgent(afterstates)
-        agent.load(save_path_format.format(i * step))
+    counts = saved_counts(save_path_format)
+
+    # 評価は複数のプロセスで並列に行い、終わった順に受け取る
+    results = [None] * len(counts)
+    for i, log, prev_log in evaluate_checkpoints(TicTacToeEnvironment, TicTacToeState, save_path_format, counts, test_games):
+        results[i] = (log, prev_log)
+        print('{}/{}'.format(counts[i], counts[-1]))
 
-        log = test_game(env, agent, randomAgent, test_games)
+    for log, prev_log in results:
         for key in log:
             plot_data['random'][key].append(log[key])
 
-        if prev_agent is not None:
-            log = test_game(env, agent, prev_agent, 1)
-            for key in log:
-                plot_data['prev'][key].append(log[key])
-
-        print('{}/{}'.format(i * step, n))
+        if prev_log is not None:
+            for key in prev_log:
+                plot_data['prev'][key].append(prev_log[key])
 
     fig = plt.figure()
     ax1 = fig.add_subplot(2, 2, 1, title='vs random agent (first move)')
@@ -117,7 +293,7 @@ if __name__ == '__main__':
     ax3 = fig.add_subplot(2, 2, 3, title='vs previous agent (first move)')
     ax4 = fig.add_subplot(2, 2, 4, title='vs previous agent (second move)')
 
-    x = np.arange(0, n + 1, step)
+    x = np.array(counts)
     ax1.stackplot(x,
                   np.array(plot_data['random']['first_move_win']),
                   np.array(plot_data['random']['first_move_draw']),
@@ -127,7 +303,7 @@ if __name__ == '__main__':
                   np.array(plot_data['random']['second_move_draw']),
                   np.array(plot_data['random']['second_move_lose']))
 
-    x = np.arange(step, n + 1, step)
+    x = np.array(counts[1:])
     ax3.stackplot(x,
                   np.array(plot_data['prev']['first_move_win']),
                   np.array(plot_data['prev']['first_move_draw']),